@@ -0,0 +1,77 @@
+"""Per-scrape CPU time of HorizonExporter and UAGExporter metric building.
+
+Run from the repository root with ``python -m benchmarks.bench_collect``.
+"""
+import argparse
+import os
+import time
+
+import xmltodict
+
+from . import data
+
+os.environ.setdefault('HORIZON_API_GATEWAY_URL', 'https://uag.invalid')
+os.environ.setdefault('HORIZON_API_GATEWAY_USERNAME', 'benchmark')
+os.environ.setdefault('HORIZON_API_GATEWAY_PASSWORD', 'benchmark')
+
+from horizon_exporter import uag_exporter  # noqa: E402
+from horizon_exporter.horizon_exporter import HorizonExporter  # noqa: E402
+
+
+class StaticHorizon:
+    def __init__(self, gateways, connection_servers, sessions):
+        self.auth_counts = {'login': 0, 'refresh': 0}
+        self._gateways = data.make_gateways(gateways)
+        self._connection_servers = data.make_connection_servers(
+            connection_servers)
+        self._sessions = data.make_sessions(sessions)
+
+    def get_monitor_gateways(self, timeout=None):
+        return self._gateways
+
+    def get_monitor_connection_servers(self, timeout=None):
+        return self._connection_servers
+
+    def iter_inventory_sessions(self, size=1000, prefetch=2, timeout=None):
+        return iter(self._sessions)
+
+    def get_inventory_sessions(self, timeout=None):
+        return self._sessions
+
+
+def cpu_per_call(func, repeat):
+    func()
+    start = time.process_time()
+    for _ in range(repeat):
+        func()
+    return (time.process_time() - start) / repeat
+
+
+def bench_horizon(args):
+    horizon = StaticHorizon(args.gateways, args.connection_servers,
+                            args.sessions)
+    exporter = HorizonExporter(pods={'pod': horizon})
+    exporter.refresh()
+    return cpu_per_call(lambda: list(exporter.collect()), args.repeat)
+
+
+def bench_uag(args):
+    exporter = uag_exporter.UAGExporter()
+    uag_data = xmltodict.parse(data.make_uag_stats_xml())
+    return cpu_per_call(lambda: exporter.collect_data(uag_data), args.repeat)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--gateways', type=int, default=100)
+    parser.add_argument('--connection-servers', type=int, default=50)
+    parser.add_argument('--sessions', type=int, default=1000)
+    parser.add_argument('--repeat', type=int, default=1000)
+    args = parser.parse_args()
+
+    print(f"horizon collect():    {bench_horizon(args) * 1e6:10.1f} us/scrape")
+    print(f"uag collect_data(): {bench_uag(args) * 1e6:10.1f} us/scrape")
+
+
+if __name__ == '__main__':
+    main()
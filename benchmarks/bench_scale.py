@@ -0,0 +1,215 @@
+"""Scale benchmarks of both exporters against the local stand-in.
+
+Each scenario starts a stand-in with the given number of gateways,
+connection servers and sessions, then measures in a fresh process:
+
+* the wall and CPU time of a Horizon snapshot refresh
+* the latency and CPU time of a scrape right after a refresh (rendered)
+  and of a repeated scrape (served from the exposition cache)
+* the latency and CPU time of a UAG probe, fetched by the probe and
+  served from the snapshot of a polled fleet
+* the peak RSS of the exporter process
+
+Results are appended to a JSON lines file, together with the commit they
+were measured on, and compared with the previous run of each scenario.
+
+Run it from the repository root with ``python -m benchmarks.bench_scale``.
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import threading
+import time
+import urllib.request
+
+
+SCENARIOS = {
+    'small': {'gateways': 10, 'connection_servers': 5, 'sessions': 1000},
+    'medium': {'gateways': 100, 'connection_servers': 50,
+               'sessions': 10000},
+    'large': {'gateways': 100, 'connection_servers': 50,
+              'sessions': 100000},
+}
+
+DEFAULT_OUTPUT = os.path.join(os.path.dirname(__file__), 'results.jsonl')
+
+
+def timed(func):
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    func()
+    return time.perf_counter() - wall, time.process_time() - cpu
+
+
+def mean(values):
+    return sum(values) / len(values)
+
+
+def fetch(url):
+    with urllib.request.urlopen(url) as response:
+        return response.read()
+
+
+def run_child(url, repeat):
+    os.environ.update({
+        'HORIZON_API_CONNECTION_URL': url,
+        'HORIZON_API_CONNECTION_DOMAIN': 'benchmark',
+        'HORIZON_API_CONNECTION_USERNAME': 'benchmark',
+        'HORIZON_API_CONNECTION_PASSWORD': 'benchmark',
+        'HORIZON_API_GATEWAY_URL': url,
+        'HORIZON_API_GATEWAY_USERNAME': 'benchmark',
+        'HORIZON_API_GATEWAY_PASSWORD': 'benchmark',
+    })
+
+    from http.server import ThreadingHTTPServer
+
+    from horizon_exporter import uag_exporter
+    from horizon_exporter.exposition import start_wsgi_server
+    from horizon_exporter.horizon_exporter import HorizonExporter, make_app
+
+    exporter = HorizonExporter()
+    httpd, _ = start_wsgi_server(0, make_app(exporter), addr='127.0.0.1')
+    metrics_url = f'http://127.0.0.1:{httpd.server_port}/metrics'
+
+    refresh, rendered, cached = [], [], []
+    for _ in range(repeat):
+        refresh.append(timed(exporter.refresh))
+        rendered.append(timed(lambda: fetch(metrics_url)))
+        cached.append(timed(lambda: fetch(metrics_url)))
+
+    uag = uag_exporter.UAGExporter()
+    handler = uag_exporter.MyRequestHandler.factory(
+        uag_exporter.horizon_uag(parse=uag.extract), uag)
+    uag_server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    threading.Thread(target=uag_server.serve_forever, daemon=True).start()
+    probe_url = (f'http://127.0.0.1:{uag_server.server_port}/probe'
+                 f'?target={url}')
+
+    probe = []
+    for _ in range(repeat):
+        probe.append(timed(lambda: fetch(probe_url)))
+
+    # The same probe against a fleet that polls the stand-in, served from
+    # the appliance's snapshot.
+    client = uag_exporter.horizon_uag(parse=uag.extract)
+    fleet = uag_exporter.UAGFleet(client, uag, targets=[url])
+    fleet_server = ThreadingHTTPServer(
+        ('127.0.0.1', 0),
+        uag_exporter.MyRequestHandler.factory(client, uag, fleet))
+    threading.Thread(target=fleet_server.serve_forever, daemon=True).start()
+    fleet_url = (f'http://127.0.0.1:{fleet_server.server_port}/probe'
+                 f'?target={url}')
+
+    fleet_probe = []
+    for _ in range(repeat):
+        fleet.refresh()
+        fleet_probe.append(timed(lambda: fetch(fleet_url)))
+
+    results = {}
+    for name, samples in (('refresh', refresh), ('scrape', rendered),
+                          ('cached_scrape', cached), ('uag_probe', probe),
+                          ('uag_fleet_probe', fleet_probe)):
+        results[f'{name}_seconds'] = mean([wall for wall, _ in samples])
+        results[f'{name}_cpu_seconds'] = mean([cpu for _, cpu in samples])
+    results['peak_rss_mb'] = \
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    json.dump(results, sys.stdout)
+
+
+def start_standin(params, latency):
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'benchmarks.standin', '--port', '0',
+         '--gateways', str(params['gateways']),
+         '--connection-servers', str(params['connection_servers']),
+         '--sessions', str(params['sessions']),
+         '--latency', str(latency), '--page-latency', str(latency),
+         '--uag-latency', str(latency)],
+        stdout=subprocess.PIPE, text=True)
+    url = process.stdout.readline().split()[-1]
+    return process, url
+
+
+def run_scenario(name, repeat, latency):
+    process, url = start_standin(SCENARIOS[name], latency)
+    try:
+        output = subprocess.run(
+            [sys.executable, '-m', 'benchmarks.bench_scale',
+             '--child', url, '--repeat', str(repeat)],
+            check=True, stdout=subprocess.PIPE, text=True).stdout
+    finally:
+        process.terminate()
+        process.wait()
+    return json.loads(output)
+
+
+def get_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], check=True,
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+            text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def load_previous(path):
+    previous = {}
+    if os.path.exists(path):
+        with open(path) as results_file:
+            for line in results_file:
+                record = json.loads(line)
+                previous[record['scenario']] = record
+    return previous
+
+
+def report(record, previous):
+    print(f"{record['scenario']} {record['parameters']}")
+    for key, value in record['results'].items():
+        line = f"  {key:28s} {value:12.6f}"
+        if previous is not None and previous['results'].get(key):
+            change = value / previous['results'][key] - 1
+            line += f"  {change:+7.1%} vs {previous['commit']}"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('scenarios', nargs='*', metavar='scenario',
+                        help=f"one of {', '.join(SCENARIOS)} (default: all)")
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds of stand-in latency per request')
+    parser.add_argument('--output', default=DEFAULT_OUTPUT)
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_child(args.child, args.repeat)
+        return
+
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+
+    previous = load_previous(args.output)
+    commit = get_commit()
+    for name in args.scenarios or SCENARIOS:
+        record = {
+            'timestamp': time.time(),
+            'commit': commit,
+            'python': platform.python_version(),
+            'scenario': name,
+            'parameters': dict(SCENARIOS[name], latency=args.latency),
+            'results': run_scenario(name, args.repeat, args.latency),
+        }
+        report(record, previous.get(name))
+        with open(args.output, 'a') as results_file:
+            results_file.write(json.dumps(record) + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,50 @@
+"""CPU time of parsing a UAG stats document, per probe.
+
+Compares the compiled extractor used by uag_exporter with a full
+xmltodict.parse() tree, and with the tree plus the debug dumps the UAG
+client used to print on every probe. Run from the repository root with
+``python -m benchmarks.bench_uag_parse``.
+"""
+import argparse
+import contextlib
+import json
+import os
+
+import xmltodict
+
+from . import data
+from .bench_collect import cpu_per_call
+
+from horizon_exporter.uag_exporter import compile_extractor
+
+
+def parse_and_dump(content):
+    with open(os.devnull, 'w') as devnull, \
+            contextlib.redirect_stdout(devnull):
+        print(content)
+        parsed = xmltodict.parse(content)
+        print(json.dumps(parsed, indent=2))
+    return parsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--protocols', type=int, default=3,
+                        help='protocol elements in the stats document')
+    parser.add_argument('--repeat', type=int, default=2000)
+    args = parser.parse_args()
+
+    protocols = [f'PROTOCOL{i}' for i in range(args.protocols)]
+    content = data.make_uag_stats_xml(protocols).encode()
+    extract = compile_extractor()
+
+    print(f"document: {len(content)} bytes")
+    for name, parse in (('xmltodict + dumps', parse_and_dump),
+                        ('xmltodict', xmltodict.parse),
+                        ('extractor', extract)):
+        seconds = cpu_per_call(lambda: parse(content), args.repeat)
+        print(f"{name:18} {seconds * 1e6:10.1f} us/probe")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+import random
+import time
+
+
+PROTOCOLS = ['BLAST', 'PCOIP', 'RDP']
+STATES = ['CONNECTED', 'DISCONNECTED', 'PENDING']
+
+
+def make_gateways(count):
+    return [{
+        'id': f'gateway-{i}',
+        'name': f'uag{i:03d}',
+        'active_connection_count': random.randint(0, 500),
+        'pcoip_connection_count': random.randint(0, 100),
+        'blast_connection_count': random.randint(0, 400),
+        'unrecognized_pcoip_requests_count': 0,
+        'unrecognized_tunnel_requests_count': 0,
+        'unrecognized_xmlapi_requests_count': 0,
+        'details': {
+            'type': 'UAG',
+            'address': f'10.0.{i // 256}.{i % 256}',
+            'internal': False,
+            'version': '2203',
+        },
+        'status': 'OK',
+        'last_updated_timestamp': int(time.time() * 1000),
+    } for i in range(count)]
+
+
+def make_connection_servers(count):
+    now = int(time.time() * 1000)
+    return [{
+        'id': f'cs-{i}',
+        'name': f'cs{i:03d}',
+        'connection_count': random.randint(0, 2000),
+        'tunnel_connection_count': random.randint(0, 100),
+        'unrecognized_pcoip_requests_count': 0,
+        'unrecognized_tunnel_requests_count': 0,
+        'unrecognized_xmlapi_requests_count': 0,
+        'details': {'build': '21553086', 'version': '8.9.0'},
+        'status': 'OK',
+        'cs_replications': [
+            {'server_name': f'cs{j:03d}', 'status': 'OK'}
+            for j in range(count) if j != i
+        ][:10],
+        'services': [
+            {'service_name': name, 'status': 'UP'}
+            for name in ('BLAST_SECURE_GATEWAY', 'PCOIP_SECURE_GATEWAY',
+                         'SECURE_GATEWAY', 'CONNECTION_SERVER')
+        ],
+        'certificate': {
+            'valid': True,
+            'valid_from': now - 86400000 * 100,
+            'valid_to': now + 86400000 * 265,
+        },
+        'last_updated_timestamp': now,
+    } for i in range(count)]
+
+
+def make_session(i, pools=50, gateways=4, now=None):
+    if now is None:
+        now = int(time.time() * 1000)
+    state = STATES[i % 7 % 3]
+    session = {
+        'id': f'session-{i:08d}',
+        'user_id': f'user-{i}',
+        'machine_id': f'machine-{i}',
+        'session_type': 'DESKTOP' if i % 5 else 'APPLICATION',
+        'session_state': state,
+        'session_protocol': PROTOCOLS[i % len(PROTOCOLS)],
+        'start_time': now - (i % 86400) * 1000,
+        'security_gateway_id': f'gateway-{i % gateways}',
+        'agent_version': '8.9.0',
+    }
+    if session['session_type'] == 'DESKTOP':
+        session['desktop_pool_id'] = f'pool-{i % pools}'
+    else:
+        session['farm_id'] = f'farm-{i % 4}'
+    if state == 'DISCONNECTED':
+        session['disconnected_time'] = now - (i % 3600) * 1000
+    return session
+
+
+def make_sessions(count, **kwargs):
+    now = int(time.time() * 1000)
+    return [make_session(i, now=now, **kwargs) for i in range(count)]
+
+
+def make_uag_stats_xml(protocols=PROTOCOLS):
+    protocol = ''.join(
+        f'<protocol name="{name}">'
+        f'<status><reason>OK</reason><status>RUNNING</status></status>'
+        f'<sessions>{random.randint(0, 500)}</sessions>'
+        f'<maxSessions>2000</maxSessions>'
+        f'<unrecognizedRequestsCount>0</unrecognizedRequestsCount>'
+        f'</protocol>'
+        for name in protocols)
+    return (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<accessPointStatusAndStats>'
+        '<overAllStatus><status>RUNNING</status></overAllStatus>'
+        '<uagVersion>22.03.0.0</uagVersion>'
+        f'<sessionCount>{random.randint(0, 2000)}</sessionCount>'
+        '<authenticatedSessionCount>800</authenticatedSessionCount>'
+        '<authenticatedViewSessionCount>780</authenticatedViewSessionCount>'
+        '<openIncomingConnectionCount>1600</openIncomingConnectionCount>'
+        '<highWaterMark>2500</highWaterMark>'
+        '<viewEdgeServiceStats>'
+        '<identifier>VIEW</identifier>'
+        '<backendStatus><reason>OK</reason><status>RUNNING</status>'
+        '</backendStatus>'
+        '<edgeServiceStatus><status>RUNNING</status></edgeServiceStatus>'
+        '<edgeServiceSessionStats>'
+        '<identifier>VIEW</identifier>'
+        '<totalSessions>820</totalSessions>'
+        '<highWaterMarkOfSessions>1200</highWaterMarkOfSessions>'
+        '<authenticatedSessions>800</authenticatedSessions>'
+        '<unauthenticatedSessions>20</unauthenticatedSessions>'
+        '<failedLoginAttempts>3</failedLoginAttempts>'
+        '<userCount>790</userCount>'
+        '</edgeServiceSessionStats>'
+        f'{protocol}'
+        '</viewEdgeServiceStats>'
+        '<applianceStats>'
+        '<freeMemoryMb>6144</freeMemoryMb>'
+        '<totalMemoryMb>16384</totalMemoryMb>'
+        '<totalCpuLoadPercent>12.5</totalCpuLoadPercent>'
+        '</applianceStats>'
+        '</accessPointStatusAndStats>'
+    )
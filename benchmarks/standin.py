@@ -0,0 +1,205 @@
+"""Local stand-in for the Horizon REST API and the UAG monitoring API.
+
+Serves synthetic data of configurable size and latency:
+
+* ``POST /rest/login`` and ``POST /rest/refresh`` hand out JWT-shaped tokens
+* ``GET /rest/monitor/v3/gateways`` and
+  ``GET /rest/monitor/v3/connection-servers``
+* ``GET /rest/inventory/v1/sessions`` with ``page``/``size`` paging
+* ``GET /rest/v1/monitor/stats``, the UAG stats document
+
+Run it with ``python -m benchmarks.standin --sessions 100000``.
+"""
+import argparse
+import base64
+import json
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+from . import data
+
+
+def make_token(ttl):
+    payload = json.dumps({'exp': int(time.time() + ttl)}).encode()
+    payload = base64.urlsafe_b64encode(payload).decode().rstrip('=')
+    return f'e30.{payload}.standin'
+
+
+def token_valid(token):
+    try:
+        payload = token.split('.')[1]
+        payload += '=' * (-len(payload) % 4)
+        return json.loads(base64.urlsafe_b64decode(payload))['exp'] > \
+            time.time()
+    except Exception:
+        return False
+
+
+class StandIn:
+    def __init__(self, gateways=10, connection_servers=5, sessions=1000,
+                 latency=0.0, page_latency=0.0, uag_latency=0.0,
+                 token_ttl=1800):
+        self.gateways = gateways
+        self.connection_servers = connection_servers
+        self.sessions = sessions
+        self.latency = latency
+        self.page_latency = page_latency
+        self.uag_latency = uag_latency
+        self.token_ttl = token_ttl
+        self.counts = {'login': 0, 'refresh': 0, 'unauthorized': 0,
+                       'requests': 0}
+        # Paths answered with 503 Service Unavailable, to stand in for an
+        # upstream outage.
+        self.failing = set()
+        self._lock = threading.Lock()
+        self._now = int(time.time() * 1000)
+
+    def count(self, key):
+        with self._lock:
+            self.counts[key] += 1
+
+    def page(self, page, size):
+        first = (page - 1) * size
+        last = min(first + size, self.sessions)
+        sessions = [data.make_session(i, now=self._now)
+                    for i in range(first, last)]
+        return sessions, last < self.sessions
+
+    def serve(self, port=0, address='127.0.0.1'):
+        server = StandInServer((address, port), StandInHandler)
+        server.standin = self
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        return server
+
+
+class StandInServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Clients going away with keep-alive connections open is expected.
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Send the headers and the body of a response in one write, so that
+    # keep-alive clients are not held up by delayed acknowledgements.
+    wbufsize = -1
+
+    @property
+    def standin(self):
+        return self.server.standin
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, body, content_type='application/json', code=200,
+              headers=()):
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        standin = self.standin
+        length = int(self.headers.get('Content-Length', 0))
+        body = json.loads(self.rfile.read(length) or b'{}')
+        time.sleep(standin.latency)
+
+        if self.path == '/rest/login':
+            standin.count('login')
+            self._send({
+                'access_token': make_token(standin.token_ttl),
+                'refresh_token': make_token(standin.token_ttl * 4),
+            })
+        elif self.path == '/rest/refresh':
+            if not token_valid(body.get('refresh_token', '')):
+                self._send({'error': 'invalid refresh token'}, code=400)
+                return
+            standin.count('refresh')
+            self._send({'access_token': make_token(standin.token_ttl)})
+        else:
+            self._send({'error': 'not found'}, code=404)
+
+    def do_GET(self):
+        standin = self.standin
+        url = urlsplit(self.path)
+        query = parse_qs(url.query)
+        standin.count('requests')
+
+        if url.path == '/rest/v1/monitor/stats':
+            time.sleep(standin.uag_latency)
+            self._send(data.make_uag_stats_xml().encode(),
+                       content_type='application/xml')
+            return
+
+        if url.path in standin.failing:
+            self._send({'error_message': 'service unavailable'}, code=503)
+            return
+
+        authorization = self.headers.get('Authorization', '')
+        if not token_valid(authorization.rpartition(' ')[2]):
+            standin.count('unauthorized')
+            self._send({'error': 'unauthorized'}, code=401)
+            return
+
+        if url.path == '/rest/monitor/v3/gateways':
+            time.sleep(standin.latency)
+            self._send(data.make_gateways(standin.gateways))
+        elif url.path == '/rest/monitor/v3/connection-servers':
+            time.sleep(standin.latency)
+            self._send(data.make_connection_servers(
+                standin.connection_servers))
+        elif url.path == '/rest/inventory/v1/sessions':
+            time.sleep(standin.page_latency)
+            page = int(query.get('page', ['1'])[0])
+            size = int(query.get('size', ['1000'])[0])
+            sessions, more = standin.page(page, size)
+            self._send(sessions, headers=[
+                ('HAS_MORE_RECORDS', 'TRUE' if more else 'FALSE')])
+        elif url.path == '/standin/counts':
+            self._send(standin.counts)
+        else:
+            self._send({'error': 'not found'}, code=404)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--port', type=int, default=18443)
+    parser.add_argument('--gateways', type=int, default=10)
+    parser.add_argument('--connection-servers', type=int, default=5)
+    parser.add_argument('--sessions', type=int, default=1000)
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds added to monitor and auth calls')
+    parser.add_argument('--page-latency', type=float, default=0.0,
+                        help='seconds added to each sessions page')
+    parser.add_argument('--uag-latency', type=float, default=0.0,
+                        help='seconds added to each UAG stats call')
+    parser.add_argument('--token-ttl', type=float, default=1800)
+    args = parser.parse_args()
+
+    standin = StandIn(args.gateways, args.connection_servers, args.sessions,
+                      args.latency, args.page_latency, args.uag_latency,
+                      args.token_ttl)
+    server = standin.serve(args.port)
+    print(f"Serving on http://127.0.0.1:{server.server_address[1]}",
+          flush=True)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,192 @@
+import gzip
+import hashlib
+import threading
+import time
+from socketserver import ThreadingMixIn
+from wsgiref.simple_server import WSGIRequestHandler, WSGIServer, make_server
+
+# Prometheus specific imports
+from prometheus_client.exposition import choose_encoder, gzip_accepted
+
+# Self-metrics
+from .instrumentation import COMPRESS_SECONDS, SERIALIZE_SECONDS
+
+
+class _Collected:
+    # Stands in for a registry whose families have already been collected,
+    # so that serialization can be timed apart from building the families.
+    def __init__(self, families):
+        self._families = families
+
+    def collect(self):
+        return iter(self._families)
+
+
+class FunctionCollector:
+    # A collector returning the metric families made by `function`.
+    def __init__(self, function):
+        self._function = function
+
+    def collect(self):
+        return iter(self._function())
+
+
+_EOF = b'# EOF\n'
+
+
+def _serialize(collectors, encoder, content_type):
+    families = _Collected([family for collector in collectors
+                           for family in collector.collect()])
+    start = time.perf_counter()
+    body = encoder(families)
+    SERIALIZE_SECONDS.labels(
+        'openmetrics' if 'openmetrics' in content_type else 'text'
+    ).observe(time.perf_counter() - start)
+    return body
+
+
+def _compress(body):
+    start = time.perf_counter()
+    body = gzip.compress(body)
+    COMPRESS_SECONDS.observe(time.perf_counter() - start)
+    return body
+
+
+class ExpositionCache:
+    # Keeps the rendered exposition of a registry for one data generation,
+    # in each format that has been asked for, plus a gzipped copy of it.
+    # Scrapers hitting the same generation reuse the bytes instead of
+    # collecting, serializing and compressing again. A registry passed to
+    # get() is only collected when its generation has not been rendered,
+    # which lets callers hand in the data that belongs to that generation.
+    #
+    # The `live` collectors, such as the exporter's own metrics and the
+    # age of its data, change with every scrape. They are rendered on
+    # every get() and appended to the cached body. A gzipped body gets
+    # them as a gzip member of their own, which decompresses as one
+    # stream with the cached member.
+    #
+    # The ETag only covers the cached body, so that it stays the same for
+    # a generation. A scrape whose If-None-Match matches it gets None for
+    # a body, and keeps the live metrics of its last full response too.
+    def __init__(self, registry=None, live=()):
+        self._registry = registry
+        self._live = live
+        self._lock = threading.Lock()
+        self._generation = None
+        self._bodies = {}
+
+    def _render(self, registry, encoder, content_type, compress, partial):
+        key = (content_type, compress, partial)
+        if key in self._bodies:
+            return self._bodies[key]
+
+        if compress:
+            body, etag = self._render(registry, encoder, content_type,
+                                      False, partial)
+            entry = (_compress(body), etag[:-1] + '-gzip"')
+        else:
+            body = _serialize([registry], encoder, content_type)
+            # The live part ends the exposition instead.
+            if partial and body.endswith(_EOF):
+                body = body[:-len(_EOF)]
+            entry = (body, f'"{hashlib.sha1(body).hexdigest()}"')
+        self._bodies[key] = entry
+        return entry
+
+    def get(self, generation, accept=None, accept_encoding=None,
+            registry=None, live=None, if_none_match=None):
+        if registry is None:
+            registry = self._registry
+        if live is None:
+            live = self._live
+        encoder, content_type = choose_encoder(accept)
+        compress = gzip_accepted(accept_encoding)
+
+        # Rendering happens under the lock, so concurrent scrapes of a new
+        # generation wait for a single render rather than all doing it.
+        with self._lock:
+            if generation != self._generation:
+                self._generation = generation
+                self._bodies = {}
+            body, etag = self._render(registry, encoder, content_type,
+                                      compress, bool(live))
+
+        headers = [
+            ('Content-Type', content_type),
+            ('ETag', etag),
+            ('Vary', 'Accept, Accept-Encoding'),
+        ]
+        if compress:
+            headers.append(('Content-Encoding', 'gzip'))
+        if etag_matches(if_none_match, headers):
+            return None, [(name, value) for name, value in headers
+                          if name in ('ETag', 'Vary')]
+
+        if live:
+            live_body = _serialize(live, encoder, content_type)
+            body += _compress(live_body) if compress else live_body
+        return body, headers
+
+
+def etag_matches(if_none_match, headers):
+    if not if_none_match:
+        return False
+    etag = dict(headers)['ETag']
+    tags = [tag.strip() for tag in if_none_match.split(',')]
+    return '*' in tags or etag in tags or f'W/{etag}' in tags
+
+
+def make_wsgi_app(cache, generation):
+    def app(environ, start_response):
+        body, headers = cache.get(
+            generation(),
+            environ.get('HTTP_ACCEPT'),
+            environ.get('HTTP_ACCEPT_ENCODING'),
+            if_none_match=environ.get('HTTP_IF_NONE_MATCH'))
+
+        if body is None:
+            start_response('304 Not Modified', headers)
+            return [b'']
+
+        start_response('200 OK', headers)
+        return [body]
+    return app
+
+
+def send_cached(handler, cache, generation, registry=None, live=None):
+    # Counterpart of the WSGI app for http.server based request handlers.
+    body, headers = cache.get(
+        generation,
+        handler.headers.get('Accept'),
+        handler.headers.get('Accept-Encoding'),
+        registry, live, handler.headers.get('If-None-Match'))
+
+    if body is None:
+        handler.send_response(304)
+        body = b''
+    else:
+        handler.send_response(200)
+        headers.append(('Content-Length', str(len(body))))
+
+    for name, value in headers:
+        handler.send_header(name, value)
+    handler.end_headers()
+    handler.wfile.write(body)
+
+
+class _ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+
+class _SilentHandler(WSGIRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+def start_wsgi_server(port, app, addr=''):
+    httpd = make_server(addr, port, app, _ThreadingWSGIServer,
+                        handler_class=_SilentHandler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    return httpd, thread
@@ -1,37 +1,92 @@
+import base64
+import codecs
+import hashlib
 import json
+import logging
 import requests
 import os
+import threading
+import time
 import xmltodict
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+# Self-metrics
+from .instrumentation import observe_upstream
+
+# Utils
+from .utils import ExpiringLRU, get_env_float, iter_json_array
+
+
+logger = logging.getLogger(__name__)
+
+# Shortest time in seconds between two scheduled token refreshes.
+MIN_REFRESH_DELAY = 10
+
+
+def get_token_expiry(token):
+    # Read the "exp" claim of a JWT without verifying it; the connection
+    # server does that. Returns None for tokens that are not JWTs.
+    try:
+        payload = token.split(".")[1]
+        payload += "=" * (-len(payload) % 4)
+        claims = json.loads(base64.urlsafe_b64decode(payload))
+        return float(claims["exp"])
+    except Exception:
+        return None
 
 
 class horizon_uag:
-    def __init__(self, url=None):
+    def __init__(self, url=None, parse=xmltodict.parse):
         if url is None:
-            self._url = os.environ['HORIZON_API_GATEWAY_URL']
+            self._url = os.environ.get('HORIZON_API_GATEWAY_URL')
         else:
             self._url = url
 
         username = os.environ['HORIZON_API_GATEWAY_USERNAME']
         password = os.environ['HORIZON_API_GATEWAY_PASSWORD']
+        self._auth = (username, password)
+        self._parse = parse
+        self.timeout = get_env_float('HORIZON_API_GATEWAY_TIMEOUT', 10)
 
-        self._session = requests.Session()
-        self._session.auth = (username, password)
-        self._data = None
-
-    def _get_xml(self, endpoint):
-        response = self._session.get(f"{self._url}{endpoint}")
-        print(response.content)
-        data = xmltodict.parse(response.content)
-        print(json.dumps(data, indent=2))
-        return data
+        # One session, and so one pool of keep-alive connections, per
+        # appliance. Repeated probes of a target reuse its open TLS
+        # connections instead of connecting again, while targets that are
+        # no longer probed have their connections closed.
+        self.max_targets = int(os.environ.get(
+            'HORIZON_API_GATEWAY_MAX_TARGETS', 128))
+        self.idle_timeout = get_env_float('HORIZON_API_GATEWAY_IDLE_TIMEOUT',
+                                          300)
+        self._sessions = ExpiringLRU(self._create_session, self.max_targets,
+                                     self.idle_timeout, requests.Session.close)
+
+    # Nothing about the probed appliance is kept on the client besides its
+    # connections, so one client can serve concurrent probes.
+
+    def _create_session(self, url):
+        session = requests.Session()
+        session.auth = self._auth
+        return session
 
-    def get_monitor(self, host):
-        self._url = f"https://{host}"
-        print(self._url)
-        self._data = self._get_xml("/rest/v1/monitor/stats")
+    def _get_xml(self, url, endpoint, timeout=None):
+        start = time.perf_counter()
+        response = self._sessions.get(url).get(f"{url}{endpoint}",
+                                               timeout=timeout)
+        response.raise_for_status()
+        content = response.content
+        request_seconds = time.perf_counter() - start
+        data = self._parse(content)
+        observe_upstream(endpoint, urlsplit(url).netloc,
+                         request_seconds, len(content),
+                         time.perf_counter() - start - request_seconds)
+        return data, hashlib.sha1(content).hexdigest()
 
-    def get_data(self):
-        return self._data
+    def get_monitor(self, host, timeout=None):
+        url = host if "://" in host else f"https://{host}"
+        if timeout is None:
+            timeout = self.timeout
+        return self._get_xml(url, "/rest/v1/monitor/stats", timeout=timeout)
 
 
 class horizon_connection_server:
@@ -41,6 +96,8 @@ class horizon_connection_server:
         else:
             self._url = url
 
+        self._target = urlsplit(self._url).netloc
+
         self._auth_data = {
             "domain": os.environ['HORIZON_API_CONNECTION_DOMAIN'],
             "username": os.environ['HORIZON_API_CONNECTION_USERNAME'],
@@ -49,6 +106,13 @@ class horizon_connection_server:
 
         self._access_token = None
         self._refresh_token = None
+        self._refresh_timer = None
+        self._closed = False
+        self._auth_lock = threading.RLock()
+        self.auth_counts = {"login": 0, "refresh": 0}
+        self._refresh_margin = get_env_float(
+            'HORIZON_API_TOKEN_REFRESH_MARGIN', 60)
+        self._timeout = get_env_float('HORIZON_API_TIMEOUT', 10)
         self._headers = {
             "accept": "*/*",
             "Content-Type": "application/json",
@@ -58,46 +122,205 @@ class horizon_connection_server:
         self._session.headers.update(self._headers)
         self._session.hooks["response"].append(self.reauthenticate)
 
-    def authenticate(self):
+    def _set_access_token(self, access_token):
+        self._access_token = access_token
+        self._session.headers.update(
+            {"Authorization": f"Bearer {self._access_token}"}
+        )
+        self._schedule_refresh()
+
+    def _login(self):
         response = self._session.post(
-            f"{self._url}/rest/login", data=json.dumps(self._auth_data)
+            f"{self._url}/rest/login", data=json.dumps(self._auth_data),
+            timeout=self._timeout
         )
+        self.auth_counts["login"] += 1
         data = response.json()
-        self._access_token = data["access_token"]
         self._refresh_token = data["refresh_token"]
-        self._session.headers.update(
-            {"Authorization": f"Bearer {self._access_token}"}
+        self._set_access_token(data["access_token"])
+
+    def _refresh(self):
+        # Fall back to a full login when there is no refresh token, when it
+        # has expired or when the connection server refuses it.
+        expiry = get_token_expiry(self._refresh_token)
+        if self._refresh_token is None or (
+                expiry is not None and expiry <= time.time()):
+            self._login()
+            return
+
+        auth_data = {"refresh_token": self._refresh_token}
+        response = self._session.post(
+            f"{self._url}/rest/refresh", data=json.dumps(auth_data),
+            timeout=self._timeout
         )
+        self.auth_counts["refresh"] += 1
+        if response.status_code != 200:
+            self._login()
+            return
+
+        data = response.json()
+        self._set_access_token(data["access_token"])
+
+    # Logins and refreshes are serialized by the auth lock, so concurrent
+    # requests never race each other into overwriting the session tokens.
+
+    def authenticate(self):
+        with self._auth_lock:
+            self._login()
+
+    def refresh(self):
+        with self._auth_lock:
+            self._refresh()
+
+    def token_expiry(self):
+        # When the current tokens expire. Unlike the tokens themselves this
+        # is safe to write out, e.g. to a snapshot file.
+        return {
+            "access": get_token_expiry(self._access_token),
+            "refresh": get_token_expiry(self._refresh_token),
+        }
+
+    def close(self):
+        # Stop refreshing the tokens and close the connections of a
+        # connection server that is no longer polled.
+        with self._auth_lock:
+            self._closed = True
+            if self._refresh_timer is not None:
+                self._refresh_timer.cancel()
+                self._refresh_timer = None
+        self._session.close()
+
+    def _refresh_if_current(self, authorization):
+        # Single-flight re-authentication: only the first request to fail
+        # with a given token refreshes it. Requests that were waiting on the
+        # lock find a different token in place and reuse it.
+        with self._auth_lock:
+            if self._session.headers.get("Authorization") == authorization:
+                self._refresh()
+
+    def _schedule_refresh(self):
+        # Refresh the access token some time before it expires, so that
+        # scrapes never have to wait for a 401 and a re-authentication.
+        if self._refresh_timer is not None:
+            self._refresh_timer.cancel()
+            self._refresh_timer = None
+
+        expiry = get_token_expiry(self._access_token)
+        if expiry is None or self._closed:
+            return
+
+        # Tokens living shorter than the margin, or clocks skewed by more
+        # than it, are refreshed halfway through their remaining lifetime,
+        # and never more often than MIN_REFRESH_DELAY, so the refreshes
+        # cannot chase each other.
+        remaining = expiry - time.time()
+        delay = max(remaining - self._refresh_margin, remaining / 2,
+                    MIN_REFRESH_DELAY)
+        self._refresh_timer = threading.Timer(
+            delay, self._refresh_in_background)
+        self._refresh_timer.daemon = True
+        self._refresh_timer.start()
+
+    def _refresh_in_background(self):
+        if self._closed:
+            return
+        try:
+            self.refresh()
+        except Exception:
+            logger.exception("Failed to refresh Horizon access token")
 
     def reauthenticate(self, r, *args, **kwargs):
         if r.status_code == 401:
-            if self._refresh_token is not None:
-                auth_data = {"refresh_token": self._refresh_token}
-                response = self._session.post(
-                    f"{self._url}/rest/refresh", data=json.dumps(auth_data)
-                )
-                data = response.json()
-                self._access_token = data["access_token"]
-                self._session.headers.update(
-                    {"Authorization": f"Bearer {self._access_token}"}
-                )
-            else:
-                self.authenticate()
+            if r.request.path_url in ("/rest/login", "/rest/refresh"):
+                return
 
+            self._refresh_if_current(r.request.headers.get("Authorization"))
+
+            # The retry is sent with the options of the original request,
+            # so it keeps its timeout.
             r.request.headers["Authorization"] = self._session.headers[
                 "Authorization"]
-            return self._session.send(r.request)
+            return self._session.send(r.request, **kwargs)
 
-    def _get(self, endpoint):
-        response = self._session.get(f"{self._url}{endpoint}")
+    def _get(self, endpoint, timeout=None):
+        start = time.perf_counter()
+        response = self._session.get(f"{self._url}{endpoint}",
+                                     timeout=timeout)
+        # An error body is not data, and must fail the fetch so that the
+        # last good data is kept and the circuit breaker counts it.
+        response.raise_for_status()
+        content = response.content
+        request_seconds = time.perf_counter() - start
         data = response.json()
+        observe_upstream(endpoint, self._target, request_seconds,
+                         len(content),
+                         time.perf_counter() - start - request_seconds)
         return data
 
-    def get_monitor_gateways(self):
-        return self._get("/rest/monitor/v3/gateways")
+    def _get_page(self, endpoint, page, size, timeout=None):
+        start = time.perf_counter()
+        response = self._session.get(
+            f"{self._url}{endpoint}", params={"page": page, "size": size},
+            timeout=timeout, stream=True)
+        request_seconds = time.perf_counter() - start
+        received = 0
+
+        def read_chunks():
+            # Network reads and decoding are interleaved here, so the time
+            # spent waiting on each chunk is accounted to the request.
+            nonlocal request_seconds, received
+            decoder = codecs.getincrementaldecoder("utf-8")()
+            chunks = response.iter_content(chunk_size=65536)
+            while True:
+                read_start = time.perf_counter()
+                chunk = next(chunks, None)
+                request_seconds += time.perf_counter() - read_start
+                if chunk is None:
+                    return
+                received += len(chunk)
+                yield decoder.decode(chunk)
+
+        with response:
+            response.raise_for_status()
+            more = response.headers.get("HAS_MORE_RECORDS", "")
+            data = list(iter_json_array(read_chunks()))
+
+        observe_upstream(endpoint, self._target, request_seconds, received,
+                         time.perf_counter() - start - request_seconds)
+        return data, more.upper() == "TRUE"
+
+    def _iter_pages(self, endpoint, size=1000, prefetch=2, timeout=None):
+        # Keep up to `prefetch` pages in flight and hand out the items of
+        # each page as soon as it arrives, so only a bounded number of
+        # pages is ever held in memory.
+        with ThreadPoolExecutor(max_workers=prefetch) as executor:
+            pending = deque()
+            for page in range(1, prefetch + 1):
+                pending.append(executor.submit(
+                    self._get_page, endpoint, page, size, timeout))
+            next_page = prefetch + 1
+
+            while pending:
+                data, more = pending.popleft().result()
+                yield from data
+                if not more or len(data) < size:
+                    for future in pending:
+                        future.cancel()
+                    return
+                pending.append(executor.submit(
+                    self._get_page, endpoint, next_page, size, timeout))
+                next_page += 1
+
+    def get_monitor_gateways(self, timeout=None):
+        return self._get("/rest/monitor/v3/gateways", timeout=timeout)
+
+    def get_monitor_connection_servers(self, timeout=None):
+        return self._get("/rest/monitor/v3/connection-servers",
+                         timeout=timeout)
 
-    def get_monitor_connection_servers(self):
-        return self._get("/rest/monitor/v3/connection-servers")
+    def iter_inventory_sessions(self, size=1000, prefetch=2, timeout=None):
+        return self._iter_pages("/rest/inventory/v1/sessions", size=size,
+                                prefetch=prefetch, timeout=timeout)
 
-    def get_inventory_sessions(self):
-        return self._get("/rest/inventory/v1/sessions")
+    def get_inventory_sessions(self, timeout=None):
+        return list(self.iter_inventory_sessions(timeout=timeout))
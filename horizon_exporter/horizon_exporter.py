@@ -1,178 +1,860 @@
-import flatdict
+import logging
+import os
+import threading
 import time
+import urllib.parse
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from fnmatch import fnmatchcase
+from functools import partial
+from itertools import groupby
+from operator import itemgetter
 
 # Prometheus specific imports
-from prometheus_client import REGISTRY, start_wsgi_server
+from prometheus_client import REGISTRY
 from prometheus_client.metrics_core import (
-    GaugeMetricFamily, InfoMetricFamily, CounterMetricFamily)
+    GaugeMetricFamily, HistogramMetricFamily, InfoMetricFamily,
+    CounterMetricFamily)
+from prometheus_client.samples import Sample
+from prometheus_client.utils import floatToGoString
+
+# Exposition
+from .exposition import (
+    ExpositionCache, FunctionCollector, make_wsgi_app, start_wsgi_server)
+
+# Self-metrics
+from .instrumentation import observe_build
 
 # Horizon API Specific imports
 from .horizon_api import horizon_connection_server
+from .sessions import (
+    DURATION_BUCKETS, IDLE_BUCKETS, SESSION_AGGREGATES, SessionTracker,
+    aggregate_sessions)
 
+# Utils
+from .utils import (
+    CircuitBreaker, CircuitOpenError, compile_path, family_enabled,
+    get_env_breaker, get_env_float, get_env_list, get_scrape_timeout,
+    read_snapshot_file, write_snapshot_file)
+
+
+logger = logging.getLogger(__name__)
+
+# Bumped whenever the layout of the snapshot file changes, so that a file
+# written by another version is ignored rather than misread.
+SNAPSHOT_VERSION = 2
+
+# Stands in for the data of an endpoint whose fetch failed.
+_FAILED = object()
+
+
+LABEL_NAMES = {
+    'gateways': ['pod', 'name'],
+    'connection_servers': ['pod', 'name'],
+    'sessions': ['pod'],
+}
+
+# Metric definitions, keyed by the endpoint that feeds them and the field of
+# each record they are read from. Fields may be dotted paths into nested
+# objects. Entries are (family type, name, documentation) with an optional
+# list of extra label names.
+METRICS = {
+    'gateways': {
+        'active_connection_count': (
+            GaugeMetricFamily,
+            'horizon_gateway_active_connection_count',
+            'VMware Horizon Gateway Active Connection Count'),
+        'pcoip_connection_count': (
+            GaugeMetricFamily,
+            'horizon_gateway_pcoip_connection_count',
+            'VMware Horizon Gateway PCoIP Connection Count'),
+        'blast_connection_count': (
+            GaugeMetricFamily,
+            'horizon_gateway_blast_connection_count',
+            'VMware Horizon Gateway Blast Connection Count'),
+        'unrecognized_pcoip_requests_count': (
+            GaugeMetricFamily,
+            'horizon_gateway_unrecognized_pcoip_requests_count',
+            'VMware Horizon Gateway Unrecognized PCoIP Requests Count'),
+        'unrecognized_tunnel_requests_count': (
+            GaugeMetricFamily,
+            'horizon_gateway_unrecognized_tunnel_requests_count',
+            'VMware Horizon Gateway Unrecognized Tunnel Requests Count'),
+        'unrecognized_xmlapi_requests_count': (
+            GaugeMetricFamily,
+            'horizon_gateway_unrecognized_xmlapi_requests_count',
+            'VMware Horizon Gateway Unrecognized XML API Requests Count'),
+        'details': (
+            InfoMetricFamily,
+            'horizon_gateway',
+            'VMware Horizon Gateway Internal Details',
+            ['type', 'address', 'internal', 'version']),
+        'status': (
+            InfoMetricFamily,
+            'horizon_gateway_status',
+            'VMware Horizon Gateway Status',
+            ['status']),
+        'last_updated_timestamp': (
+            GaugeMetricFamily,
+            'horizon_gateway_last_updated',
+            'VMware Horizon Gateway last updated'),
+    },
+    'connection_servers': {
+        'connection_count': (
+            GaugeMetricFamily,
+            'horizon_connection_server_connection_count',
+            'VMware Horizon Connection Server Connection Count'),
+        'tunnel_connection_count': (
+            GaugeMetricFamily,
+            'horizon_connection_server_tunnel_connection_count',
+            'VMware Horizon Connection Server Tunnel Connection Count'),
+        'unrecognized_pcoip_requests_count': (
+            GaugeMetricFamily,
+            'horizon_connection_server_unrecognized_pcoip_requests_count',
+            'VMware Horizon Connection Server Unrecognized PCoIP '
+            'Requests Count'),
+        'unrecognized_tunnel_requests_count': (
+            GaugeMetricFamily,
+            'horizon_connection_server_unrecognized_tunnel_requests_count',
+            'VMware Horizon Connection Server Unrecognized Tunnel '
+            'Requests Count'),
+        'unrecognized_xmlapi_requests_count': (
+            GaugeMetricFamily,
+            'horizon_connection_server_unrecognized_xmlapi_requests_count',
+            'VMware Horizon Connection Server Unrecognized XML API '
+            'Requests Count'),
+        'details': (
+            InfoMetricFamily,
+            'horizon_connection_server',
+            'VMware Horizon Connecton Server Internal Details',
+            ['build', 'version']),
+        'status': (
+            InfoMetricFamily,
+            'horizon_connection_server_status',
+            'VMware Horizon Connection Server Status',
+            ['status']),
+        'cs_replications': (
+            InfoMetricFamily,
+            'horizon_connection_server_replication',
+            'VMware Horizon Connection Server Replication Info',
+            ['server_name', 'status']),
+        'services': (
+            InfoMetricFamily,
+            'horizon_connection_server_service',
+            'VMware Horizon Connection Server Service Info',
+            ['service_name', 'status']),
+        'certificate.valid_from': (
+            GaugeMetricFamily,
+            'horizon_connection_server_certificate_valid_from',
+            'VMware Horizon Connection Server Certificate Valid From'),
+        'certificate.valid_to': (
+            GaugeMetricFamily,
+            'horizon_connection_server_certificate_valid_to',
+            'VMware Horizon Connection Server Certificate Valid To'),
+        'last_updated_timestamp': (
+            GaugeMetricFamily,
+            'horizon_connection_server_last_updated',
+            'VMware Horizon Connection Server last updated'),
+    },
+    'sessions': {
+        'total': (
+            GaugeMetricFamily,
+            'horizon_session_count',
+            'VMware Horizon Session Count'),
+        'session_state': (
+            GaugeMetricFamily,
+            'horizon_session_state_count',
+            'VMware Horizon Session Count by State',
+            [SESSION_AGGREGATES['session_state']]),
+        'session_protocol': (
+            GaugeMetricFamily,
+            'horizon_session_protocol_count',
+            'VMware Horizon Session Count by Protocol',
+            [SESSION_AGGREGATES['session_protocol']]),
+        'session_type': (
+            GaugeMetricFamily,
+            'horizon_session_type_count',
+            'VMware Horizon Session Count by Type',
+            [SESSION_AGGREGATES['session_type']]),
+        'desktop_pool_id': (
+            GaugeMetricFamily,
+            'horizon_session_desktop_pool_count',
+            'VMware Horizon Session Count by Desktop Pool',
+            [SESSION_AGGREGATES['desktop_pool_id']]),
+        'farm_id': (
+            GaugeMetricFamily,
+            'horizon_session_farm_count',
+            'VMware Horizon Session Count by Farm',
+            [SESSION_AGGREGATES['farm_id']]),
+        'security_gateway_id': (
+            GaugeMetricFamily,
+            'horizon_session_gateway_count',
+            'VMware Horizon Session Count by Gateway',
+            [SESSION_AGGREGATES['security_gateway_id']]),
+        'events': (
+            CounterMetricFamily,
+            'horizon_session_events',
+            'VMware Horizon Session Starts, Ends, Disconnects and Reconnects',
+            ['event']),
+        'duration': (
+            HistogramMetricFamily,
+            'horizon_session_duration_seconds',
+            'VMware Horizon Session Duration by Desktop Pool and Farm',
+            [SESSION_AGGREGATES['desktop_pool_id'],
+             SESSION_AGGREGATES['farm_id']]),
+        'idle': (
+            HistogramMetricFamily,
+            'horizon_session_idle_seconds',
+            'VMware Horizon Disconnected Session Idle Time by Desktop Pool '
+            'and Farm',
+            [SESSION_AGGREGATES['desktop_pool_id'],
+             SESSION_AGGREGATES['farm_id']]),
+    },
+}
+
+
+# The fillers append samples to the family directly rather than going
+# through add_metric(), which rebuilds the label dict from the label names
+# for every sample.
+def _value_filler(key, convert, suffix=''):
+    # `suffix` is the one add_metric() would give the samples, e.g. _total
+    # for counters.
+    get = compile_path(key)
+
+    def fill(metric, all_data, pod):
+        append = metric.samples.append
+        name = f'{metric.name}{suffix}'
+        for _data in all_data:
+            append(Sample(name, {'pod': pod, 'name': _data['name']},
+                          convert(get(_data)), None))
+    return fill
+
+
+def _info_filler(key):
+    get = compile_path(key)
+    label = key.rsplit('.', 1)[-1]
+
+    def fill(metric, all_data, pod):
+        append = metric.samples.append
+        name = f'{metric.name}_info'
+        for _data in all_data:
+            value = get(_data)
+            if type(value) is dict:
+                _dict = [value]
+            elif type(value) is list:
+                _dict = value
+            else:
+                _dict = [{label: value}]
+            for _d in _dict:
+                labels = {'pod': pod, 'name': _data['name']}
+                for k, v in _d.items():
+                    labels[k] = str(v)
+                append(Sample(name, labels, 1, None))
+    return fill
+
+
+def _session_filler(key):
+    def fill(metric, aggregates, pod):
+        if key == 'total':
+            metric.add_metric([pod], float(aggregates[key]))
+            return
+        add_metric = metric.add_metric
+        for value, count in aggregates[key].items():
+            add_metric([pod, str(value)], float(count))
+    return fill
 
-class HorizonExporter:
-    def __init__(self):
-        self.horizon = horizon_connection_server()
 
-    def _create_metric_list(self):
+def _histogram_filler(key):
+    def fill(metric, aggregates, pod):
+        histogram = aggregates[key]
+        bounds = [floatToGoString(bound) for bound in histogram['buckets']]
+        bounds.append('+Inf')
+        for desktop_pool_id, farm_id, counts, total in histogram['pools']:
+            metric.add_metric([pod, desktop_pool_id, farm_id],
+                              list(zip(bounds, counts)), total)
+    return fill
 
-        self._label_names = {
-            'gateways': ['name'],
-            'connection_servers': ['name'],
+
+def compile_metrics(enabled=(), disabled=()):
+    # Turn METRICS into a flat table of (endpoint, family type, name,
+    # documentation, labels, filler) so that a scrape is a single loop with
+    # no per-family dispatch. Families not selected by the enabled/disabled
+    # name patterns are left out.
+    table = []
+    for list_key, metrics in METRICS.items():
+        for key, (factory, name, documentation, *extra) in metrics.items():
+            if not family_enabled(name, enabled, disabled):
+                continue
+            labels = LABEL_NAMES[list_key] + (extra[0] if extra else [])
+            if factory is HistogramMetricFamily:
+                fill = _histogram_filler(key)
+            elif list_key == 'sessions':
+                fill = _session_filler(key)
+            elif factory is InfoMetricFamily:
+                fill = _info_filler(key)
+            elif factory is CounterMetricFamily:
+                fill = _value_filler(key, int, '_total')
+            else:
+                fill = _value_filler(key, float)
+            table.append(
+                (list_key, factory, name, documentation, labels, fill))
+    return table
+
+
+def get_pod_urls():
+    # HORIZON_EXPORTER_PODS lists the pods to poll as "name=url" or bare
+    # URLs, separated by commas. Without it, the single connection server
+    # in HORIZON_API_CONNECTION_URL is used.
+    pods = {}
+    for entry in get_env_list('HORIZON_EXPORTER_PODS'):
+        name, _, url = entry.rpartition('=')
+        pods[name or get_pod_name(url)] = url
+
+    if not pods:
+        url = os.environ['HORIZON_API_CONNECTION_URL']
+        name = os.environ.get('HORIZON_EXPORTER_POD_NAME') or \
+            get_pod_name(url)
+        pods[name] = url
+    return pods
+
+
+def get_pod_name(url):
+    return urllib.parse.urlsplit(url).hostname or url
+
+
+class HorizonPod:
+    def __init__(self, name, horizon, endpoints, breaker=CircuitBreaker,
+                 tracker=None):
+        self.name = name
+        self.horizon = horizon
+        self.endpoints = endpoints
+        # The sessions seen by the last fetch of the sessions inventory.
+        self.tracker = tracker
+        # The pool the endpoints are fetched on, when not the exporter's.
+        self.executor = None
+
+        # Each endpoint has its own circuit breaker, and at most one call in
+        # flight. A call still running from an earlier refresh is waited on
+        # again rather than joined by another one, and its result goes into
+        # the snapshot as soon as it arrives.
+        self.breakers = {key: breaker() for key in endpoints}
+        self.pending = {}
+        self.late = set()
+        # When each endpoint is next due for a fetch, on the
+        # time.monotonic() clock.
+        self.due = dict.fromkeys(endpoints, 0)
+
+        # The snapshot is replaced as a whole by a refresh, so collect()
+        # only ever sees a complete set of data from one refresh.
+        self.snapshot = None
+        self.snapshot_lock = threading.Lock()
+        self.lock = threading.Lock()
+        self.last_probe = time.monotonic()
+
+    @property
+    def generation(self):
+        snapshot = self.snapshot
+        return snapshot['generation'] if snapshot else 0
+
+
+class HorizonExporter:
+    def __init__(self, pods=None, interval=None):
+        if interval is None:
+            interval = float(
+                os.environ.get('HORIZON_EXPORTER_POLL_INTERVAL', 30))
+        self._interval = interval
+
+        # Metric families can be switched on and off with shell-style
+        # patterns matched against their names. Only the endpoints feeding
+        # at least one enabled family are fetched.
+        self._table = compile_metrics(
+            get_env_list('HORIZON_EXPORTER_ENABLED_FAMILIES'),
+            get_env_list('HORIZON_EXPORTER_DISABLED_FAMILIES'))
+        self._required = [
+            key for key in ('gateways', 'sessions', 'connection_servers')
+            if key in {entry[0] for entry in self._table}
+        ]
+        self._empty = {
+            'gateways': [],
+            'sessions': aggregate_sessions([]),
+            'connection_servers': [],
+        }
+        # Every endpoint is fetched on its own cadence, so that slow-changing
+        # data is not downloaded and rebuilt as often as the counts.
+        self._intervals = {
+            key: get_env_float(
+                f'HORIZON_EXPORTER_POLL_INTERVAL_{key.upper()}', interval)
+            for key in self._required
         }
+        # Families of the configured pods by endpoint, rebuilt only when
+        # the endpoint's data was fetched again.
+        self._built = {}
 
-        self.metric_list = {}
-        self.metric_list['gateways'] = {
-            'active_connection_count': GaugeMetricFamily(
-                'horizon_gateway_active_connection_count',
-                'VMware Horizon Gateway Active Connection Count',
-                labels=self._label_names['gateways']),
-            'pcoip_connection_count': GaugeMetricFamily(
-                'horizon_gateway_pcoip_connection_count',
-                'VMware Horizon Gateway PCoIP Connection Count',
-                labels=self._label_names['gateways']),
-            'blast_connection_count': GaugeMetricFamily(
-                'horizon_gateway_blast_connection_count',
-                'VMware Horizon Gateway Blast Connection Count',
-                labels=self._label_names['gateways']),
-            'unrecognized_pcoip_requests_count': GaugeMetricFamily(
-                'horizon_gateway_unrecognized_pcoip_requests_count',
-                'VMware Horizon Gateway Unrecognized PCoIP Requests Count',
-                labels=self._label_names['gateways']),
-            'unrecognized_tunnel_requests_count': GaugeMetricFamily(
-                'horizon_gateway_unrecognized_tunnel_requests_count',
-                'VMware Horizon Gateway Unrecognized Tunnel Requests Count',
-                labels=self._label_names['gateways']),
-            'unrecognized_xmlapi_requests_count': GaugeMetricFamily(
-                'horizon_gateway_unrecognized_xmlapi_requests_count',
-                'VMware Horizon Gateway Unrecognized XML API Requests Count',
-                labels=self._label_names['gateways']),
-            'details': InfoMetricFamily(
-                'horizon_gateway',
-                'VMware Horizon Gateway Internal Details',
-                labels=self._label_names['gateways'] +
-                ['type', 'address', 'internal', 'version']),
-            'status': InfoMetricFamily(
-                'horizon_gateway_status',
-                'VMware Horizon Gateway Status',
-                labels=self._label_names['gateways'] + ['status']),
-            'last_updated_timestamp': GaugeMetricFamily(
-                'horizon_gateway_last_updated',
-                'VMware Horizon Gateway last updated',
-                labels=self._label_names['gateways']),
+        timeout = get_env_float('HORIZON_EXPORTER_TIMEOUT', 10)
+        self._timeouts = {
+            key: get_env_float(
+                f'HORIZON_EXPORTER_TIMEOUT_{key.upper()}', timeout)
+            for key in self._required
         }
+        self.max_timeout = max(self._timeouts.values(), default=timeout)
+        self._breaker = get_env_breaker('HORIZON_EXPORTER')
+        self._duration_buckets = sorted(
+            float(bound) for bound in
+            get_env_list('HORIZON_EXPORTER_SESSION_DURATION_BUCKETS')
+        ) or DURATION_BUCKETS
+        self._idle_buckets = sorted(
+            float(bound) for bound in
+            get_env_list('HORIZON_EXPORTER_SESSION_IDLE_BUCKETS')
+        ) or IDLE_BUCKETS
+        self._page_size = int(os.environ.get(
+            'HORIZON_EXPORTER_SESSIONS_PAGE_SIZE', 1000))
+        self._prefetch = int(os.environ.get(
+            'HORIZON_EXPORTER_SESSIONS_PREFETCH', 2))
+
+        if pods is None:
+            pods = {name: horizon_connection_server(url)
+                    for name, url in get_pod_urls().items()}
+        self._pods = {name: self._create_pod(name, horizon)
+                      for name, horizon in pods.items()}
+
+        # Pods requested with ?target= that are not configured are only
+        # accepted when they match one of these patterns, as probing hands
+        # the Horizon credentials to the target. They are dropped again
+        # once they have not been probed for a while.
+        self._probe_patterns = get_env_list('HORIZON_EXPORTER_PROBE_TARGETS')
+        self._probe_expiry = get_env_float(
+            'HORIZON_EXPORTER_PROBE_EXPIRY', 600)
+        self._probes = {}
+        self._probes_lock = threading.Lock()
 
-        self.metric_list['connection_servers'] = {
-            'connection_count': GaugeMetricFamily(
-                'horizon_connection_server_connection_count',
-                'VMware Horizon Connection Server Connection Count',
-                labels=self._label_names['connection_servers']),
-            'tunnel_connection_count': GaugeMetricFamily(
-                'horizon_connection_server_tunnel_connection_count',
-                'VMware Horizon Connection Server Tunnel Connection Count',
-                labels=self._label_names['connection_servers']),
-            'unrecognized_pcoip_requests_count': GaugeMetricFamily(
-                'horizon_connection_server_unrecognized_pcoip_requests_count',
-                'VMware Horizon Connection Server Unrecognized PCoIP '
-                'Requests Count',
-                labels=self._label_names['connection_servers']),
-            'unrecognized_tunnel_requests_count': GaugeMetricFamily(
-                'horizon_connection_server_unrecognized_tunnel_requests_count',
-                'VMware Horizon Connection Server Unrecognized Tunnel '
-                'Requests Count',
-                labels=self._label_names['connection_servers']),
-            'unrecognized_xmlapi_requests_count': GaugeMetricFamily(
-                'horizon_connection_server_unrecognized_xmlapi_requests_count',
-                'VMware Horizon Connection Server Unrecognized XML API '
-                'Requests Count',
-                labels=self._label_names['connection_servers']),
-            'details': InfoMetricFamily(
-                'horizon_connection_server',
-                'VMware Horizon Connecton Server Internal Details',
-                labels=self._label_names['connection_servers'] +
-                ['build', 'version']),
-            'status': InfoMetricFamily(
-                'horizon_connection_server_status',
-                'VMware Horizon Connection Server Status',
-                labels=self._label_names['connection_servers'] + ['status']),
-            'cs_replications': InfoMetricFamily(
-                'horizon_connection_server_replication',
-                'VMware Horizon Connection Server Replication Info',
-                labels=self._label_names['connection_servers'] +
-                ['server_name', 'status']),
-            'services': InfoMetricFamily(
-                'horizon_connection_server_service',
-                'VMware Horizon Connection Server Service Info',
-                labels=self._label_names['connection_servers'] +
-                ['service_name', 'status']),
-            'certificate.valid_from': GaugeMetricFamily(
-                'horizon_connection_server_certificate_valid_from',
-                'VMware Horizon Connection Server Certificate Valid From',
-                labels=self._label_names['connection_servers']),
-            'certificate.valid_to': GaugeMetricFamily(
-                'horizon_connection_server_certificate_valid_to',
-                'VMware Horizon Connection Server Certificate Valid To',
-                labels=self._label_names['connection_servers']),
-            'last_updated_timestamp': GaugeMetricFamily(
-                'horizon_connection_server_last_updated',
-                'VMware Horizon Connection Server last updated',
-                labels=self._label_names['connection_servers']),
+        # Every endpoint of every pod is requested at once, so a refresh
+        # takes as long as the slowest call rather than the sum of them.
+        self._executor = ThreadPoolExecutor(
+            max_workers=int(os.environ.get(
+                'HORIZON_EXPORTER_FETCH_WORKERS',
+                max(1, len(self._required) * len(self._pods)))),
+            thread_name_prefix='horizon-fetch')
+
+        # The snapshots of the configured pods are written to this file after
+        # every refresh, and read back at startup, so a restarted exporter
+        # serves the last data, marked with its age, until its first
+        # refresh has finished.
+        self._snapshot_file = os.environ.get(
+            'HORIZON_EXPORTER_SNAPSHOT_FILE')
+        self._saved_generation = None
+
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _create_pod(self, name, horizon):
+        tracker = SessionTracker(self._duration_buckets, self._idle_buckets)
+        endpoints = {
+            'gateways': horizon.get_monitor_gateways,
+            'sessions': partial(self._fetch_sessions, horizon, tracker),
+            'connection_servers': horizon.get_monitor_connection_servers,
         }
+        return HorizonPod(name, horizon, {
+            key: endpoints[key] for key in self._required}, self._breaker,
+            tracker)
+
+    def _fetch_sessions(self, horizon, tracker, timeout=None):
+        return tracker.aggregate(horizon.iter_inventory_sessions(
+            size=self._page_size, prefetch=self._prefetch, timeout=timeout))
+
+    def _submit(self, pod, keys, start):
+        for key in keys:
+            pod.due[key] = start + self._intervals[key]
+            future = pod.pending.get(key)
+            if future is None or future.done():
+                pod.pending[key] = (pod.executor or self._executor).submit(
+                    pod.breakers[key].call, pod.endpoints[key],
+                    timeout=self._timeouts[key])
+        return {key: pod.pending[key] for key in keys}
+
+    def _complete(self, pod, futures, start, deadline=None):
+        updates = {}
+        late = []
+        for key, future in futures.items():
+            end = start + self._timeouts[key]
+            if deadline is not None:
+                end = min(end, deadline)
+            try:
+                updates[key] = future.result(
+                    timeout=max(0, end - time.monotonic()))
+                continue
+            except CircuitOpenError:
+                logger.debug("Circuit open for Horizon %s from %s",
+                             key, pod.name)
+            except TimeoutError:
+                if future.done():
+                    logger.exception("Failed to fetch Horizon %s from %s",
+                                     key, pod.name)
+                else:
+                    logger.warning("Horizon %s from %s is still being "
+                                   "fetched, keeping its previous data",
+                                   key, pod.name)
+                    late.append((key, future))
+            except Exception:
+                logger.exception("Failed to fetch Horizon %s from %s",
+                                 key, pod.name)
+            updates[key] = _FAILED
+
+        self._update_snapshot(pod, updates)
+        # A call that outlasts its refresh is not wasted: its result is put
+        # into the snapshot once it arrives.
+        for key, future in late:
+            if future not in pod.late:
+                pod.late.add(future)
+                future.add_done_callback(
+                    partial(self._complete_late, pod, key))
+
+    def _complete_late(self, pod, key, future):
+        pod.late.discard(future)
+        if future.cancelled():
+            return
+        if future.exception() is not None:
+            logger.warning("Failed to fetch Horizon %s from %s: %s",
+                           key, pod.name, future.exception())
+            self._update_snapshot(pod, {key: _FAILED})
+            return
+        self._update_snapshot(pod, {key: future.result()})
+
+    def _update_snapshot(self, pod, updates):
+        # Late results may arrive while a refresh completes, so the snapshot
+        # is rebuilt from the current one under the pod's snapshot lock.
+        with pod.snapshot_lock:
+            previous = pod.snapshot or {'data': {}, 'status': {}}
+            # Endpoints that were not updated keep their data and status.
+            api_data = {key: previous['data'].get(key, self._empty[key])
+                        for key in pod.endpoints}
+            status = {key: previous['status'].get(key, (False, None, False))
+                      for key in pod.endpoints}
+            for key, data in updates.items():
+                if data is not _FAILED:
+                    api_data[key] = data
+                    status[key] = (True, time.time(), False)
+                    continue
+                # The data of the last successful fetch is kept, and the
+                # endpoint reports how old it is.
+                status[key] = (
+                    False, status[key][1],
+                    pod.breakers[key].state != CircuitBreaker.CLOSED)
+
+            pod.snapshot = {
+                'timestamp': time.time(),
+                'generation': pod.generation + 1,
+                'data': api_data,
+                'status': status,
+            }
+
+    def refresh(self, pods=None, deadline=None, due_only=False):
+        # A refresh ends at `deadline` (on the time.monotonic() clock) at the
+        # latest. Endpoints that have not answered by then keep their
+        # previous data. With `due_only`, only the endpoints whose interval
+        # has passed are fetched, and pods with none of them are left as
+        # they are.
+        if pods is None:
+            pods = self._active_pods()
+
+        start = time.monotonic()
+        futures = []
+        for pod in pods:
+            keys = [key for key in pod.endpoints
+                    if not due_only or pod.due[key] <= start]
+            if keys:
+                futures.append((pod, self._submit(pod, keys, start)))
+        for pod, pod_futures in futures:
+            self._complete(pod, pod_futures, start, deadline)
+
+    def _active_pods(self):
+        now = time.monotonic()
+        with self._probes_lock:
+            for name, pod in list(self._probes.items()):
+                if now - pod.last_probe > self._probe_expiry:
+                    del self._probes[name]
+                    pod.horizon.close()
+                    pod.executor.shutdown(wait=False, cancel_futures=True)
+            return list(self._pods.values()) + list(self._probes.values())
+
+    def is_active(self, pod):
+        # Whether `pod` is configured, or a probed pod that has not expired.
+        with self._probes_lock:
+            return pod is self._pods.get(pod.name) or \
+                pod is self._probes.get(pod.name)
+
+    def probe(self, target, deadline=None):
+        pod = self._pods.get(target)
+        if pod is None:
+            with self._probes_lock:
+                pod = self._probes.get(target)
+                if pod is None:
+                    if not any(fnmatchcase(target, pattern)
+                               for pattern in self._probe_patterns):
+                        return None
+                    url = target if '://' in target else f'https://{target}'
+                    pod = self._create_pod(
+                        target, horizon_connection_server(url))
+                    # Probed pods have threads of their own, so that their
+                    # first refresh is not queued behind the calls of the
+                    # configured pods until its deadline has passed.
+                    pod.executor = ThreadPoolExecutor(
+                        max_workers=max(1, len(self._required)),
+                        thread_name_prefix='horizon-probe')
+                    self._probes[target] = pod
+
+        pod.last_probe = time.monotonic()
+        with pod.lock:
+            if pod.snapshot is None:
+                self.refresh([pod], deadline)
+        return pod
+
+    def get_collector(self, pod):
+        return FunctionCollector(partial(self.collect_pods, [pod]))
+
+    def get_data_collector(self, pod=None):
+        # The families of the Horizon data of `pod`, or of the configured
+        # pods, which only change with the generation.
+        if pod is None:
+            return FunctionCollector(lambda: self.collect_pod_data(
+                list(self._pods.values()), self._built))
+        return FunctionCollector(partial(self.collect_pod_data, [pod]))
 
-        self.metric_list['sessions'] = {}
+    def get_status_collector(self, pod=None):
+        # The status and age families of `pod`, or of the configured pods,
+        # which change with every scrape.
+        if pod is None:
+            return FunctionCollector(
+                lambda: self.collect_pod_status(list(self._pods.values())))
+        return FunctionCollector(partial(self.collect_pod_status, [pod]))
+
+    @property
+    def generation(self):
+        return tuple(pod.generation for pod in self._pods.values())
+
+    def save_snapshot(self):
+        # Write the snapshots of the configured pods, unless nothing changed
+        # since they were last written. Access and refresh tokens are not
+        # written, only when they expire.
+        generation = self.generation
+        if generation == self._saved_generation:
+            return
+        pods = {}
+        for name, pod in self._pods.items():
+            snapshot = pod.snapshot
+            if snapshot is None:
+                continue
+            pods[name] = {
+                'timestamp': snapshot['timestamp'],
+                'data': snapshot['data'],
+                'status': snapshot['status'],
+                'token_expiry': pod.horizon.token_expiry(),
+                'session_index': pod.tracker.dump(),
+            }
+        write_snapshot_file(self._snapshot_file, {
+            'version': SNAPSHOT_VERSION,
+            'pods': pods,
+        })
+        self._saved_generation = generation
+
+    def load_snapshot(self):
+        # Restore the snapshots written by save_snapshot() for the pods that
+        # are still configured. Their circuits start closed and all their
+        # endpoints are due, so the first refresh replaces them.
+        state = read_snapshot_file(self._snapshot_file, SNAPSHOT_VERSION)
+        if state is None:
+            return
+        for name, saved in state['pods'].items():
+            pod = self._pods.get(name)
+            if pod is None:
+                continue
+            api_data = {}
+            status = {}
+            for key in pod.endpoints:
+                data = saved['data'].get(key, self._empty[key])
+                if key == 'sessions':
+                    data = {field: Counter(value)
+                            if isinstance(value, dict) else value
+                            for field, value in data.items()}
+                api_data[key] = data
+                success, timestamp, _ = saved['status'].get(
+                    key, (False, None, False))
+                status[key] = (success, timestamp, False)
+            pod.snapshot = {
+                'timestamp': saved['timestamp'],
+                'generation': pod.generation + 1,
+                'data': api_data,
+                'status': status,
+            }
+            # The session events counted from here on include those that
+            # happened while the exporter was down.
+            if saved.get('session_index') is not None:
+                pod.tracker.restore(saved['session_index'])
+            logger.info("Loaded snapshot of pod %s, %.0f seconds old",
+                        name, time.time() - saved['timestamp'])
+        self._saved_generation = self.generation
+
+    def _poll(self):
+        while not self._stop.is_set():
+            try:
+                self.refresh(due_only=True)
+            except Exception:
+                logger.exception("Failed to refresh Horizon snapshot")
+            if self._snapshot_file:
+                try:
+                    self.save_snapshot()
+                except Exception:
+                    logger.exception("Failed to write snapshot file %s",
+                                     self._snapshot_file)
+            # Sleep until the next endpoint is due. Probed pods added in the
+            # meantime have been refreshed as a whole by their first probe.
+            due = [due for pod in self._active_pods()
+                   for due in pod.due.values()]
+            next_due = min(due, default=time.monotonic() + self._interval)
+            self._stop.wait(max(0, next_due - time.monotonic()))
+
+    def start(self):
+        if self._snapshot_file:
+            self.load_snapshot()
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._poll, name='horizon-poller', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def collect_pods(self, pods, built=None):
+        return (self.collect_pod_data(pods, built)
+                + self.collect_pod_status(pods))
+
+    def collect_pod_data(self, pods, built=None):
+        # `built` keeps the families of each endpoint between calls, and
+        # those of an endpoint whose data objects are unchanged are reused.
+        if built is None:
+            built = {}
+        snapshots = [(pod.name, pod.snapshot['data'])
+                     for pod in pods if pod.snapshot is not None]
+        if not snapshots:
+            return []
+
+        start = time.perf_counter()
+        names = [pod for pod, api_data in snapshots]
+        families = []
+        for list_key, entries in groupby(self._table, itemgetter(0)):
+            data = [api_data[list_key] for pod, api_data in snapshots]
+            previous = built.get(list_key)
+            if previous is not None and previous[0] == names and all(
+                    old is new for old, new in zip(previous[1], data)):
+                families += previous[2]
+                continue
+
+            endpoint_families = []
+            for _, factory, name, documentation, labels, fill in entries:
+                metric = factory(name, documentation, labels=labels)
+                for pod, endpoint_data in zip(names, data):
+                    fill(metric, endpoint_data, pod)
+                endpoint_families.append(metric)
+            built[list_key] = (names, data, endpoint_families)
+            families += endpoint_families
+
+        observe_build('horizon', time.perf_counter() - start, families)
+        return families
+
+    def collect_pod_status(self, pods):
+        families = []
+        metric = CounterMetricFamily(
+            'horizon_exporter_authentications',
+            'Logins and token refreshes made against the Horizon REST API',
+            labels=['pod', 'kind'])
+        for pod in pods:
+            for kind, count in pod.horizon.auth_counts.items():
+                metric.add_metric([pod.name, kind], count)
+        families.append(metric)
+
+        up = GaugeMetricFamily(
+            'horizon_exporter_upstream_up',
+            'Whether the last fetch of a Horizon REST endpoint succeeded',
+            labels=['pod', 'endpoint'])
+        age = GaugeMetricFamily(
+            'horizon_exporter_snapshot_age_seconds',
+            'Age of the served data of a Horizon REST endpoint',
+            labels=['pod', 'endpoint'])
+        circuit = GaugeMetricFamily(
+            'horizon_exporter_circuit_open',
+            'Whether calls to a Horizon REST endpoint are suspended',
+            labels=['pod', 'endpoint'])
+        now = time.time()
+        for pod in pods:
+            if pod.snapshot is None:
+                continue
+            for key, (success, timestamp, circuit_open) in \
+                    pod.snapshot['status'].items():
+                up.add_metric([pod.name, key], float(success))
+                if timestamp is not None:
+                    age.add_metric([pod.name, key], now - timestamp)
+                circuit.add_metric([pod.name, key], float(circuit_open))
+        families += [up, age, circuit]
+        return families
 
     def collect(self):
-        self._create_metric_list()
-
-        connection = self.horizon.get_monitor_connection_servers()
-
-        conn = []
-        for c in connection:
-            d = flatdict.FlatDict({'certificate': c['certificate']},
-                                  delimiter='.')
-            for k, v in d.items():
-                c[k] = v
-            conn.append(c)
-
-        api_data = {
-            'gateways': self.horizon.get_monitor_gateways(),
-            'sessions': self.horizon.get_inventory_sessions(),
-            'connection_servers': conn
-        }
+        return self.collect_pods(list(self._pods.values()), self._built)
+
+
+def make_app(exporter, registry=REGISTRY):
+    # Without a target the configured pods are served together, along with
+    # `registry`, which must not hold the exporter itself. With ?target=
+    # only the named pod is, from its own cache. Only the Horizon data is
+    # cached; the status families and the registry are rendered on every
+    # scrape.
+    cache = ExpositionCache(exporter.get_data_collector(),
+                            [exporter.get_status_collector(), registry])
+    metrics_app = make_wsgi_app(cache, lambda: exporter.generation)
+    probe_caches = {}
+    probe_caches_lock = threading.Lock()
+    scrape_offset = get_env_float('HORIZON_EXPORTER_SCRAPE_TIMEOUT_OFFSET',
+                                  0.5)
+
+    def app(environ, start_response):
+        query = urllib.parse.parse_qs(environ.get('QUERY_STRING', ''))
+        if 'target' not in query:
+            return metrics_app(environ, start_response)
+
+        # A target that has not been fetched yet is refreshed within the
+        # scrape timeout, and served with whatever arrived by then.
+        timeout = get_scrape_timeout(
+            environ.get('HTTP_X_PROMETHEUS_SCRAPE_TIMEOUT_SECONDS'),
+            exporter.max_timeout, scrape_offset)
+        pod = exporter.probe(query['target'][0],
+                             time.monotonic() + timeout)
+        if pod is None:
+            start_response('404 Not Found', [('Content-Type', 'text/plain')])
+            return [b'Unknown target\n']
 
-        for list_key, all_data in api_data.items():
-            for key, metric in self.metric_list[list_key].items():
-                if type(metric) is GaugeMetricFamily:
-                    for _data in all_data:
-                        labels = [_data['name']]
-                        metric.add_metric(labels, float(_data[key]))
-                    yield metric
-                elif type(metric) is CounterMetricFamily:
-                    for _data in all_data:
-                        labels = [_data['name']]
-                        metric.add_metric(labels, int(_data[key]))
-                    yield metric
-                elif type(metric) is InfoMetricFamily:
-                    for _data in all_data:
-                        labels = [_data['name']]
-                        if type(_data[key]) is dict:
-                            _dict = [_data[key]]
-                        elif type(_data[key]) is list:
-                            _dict = _data[key]
-                        elif type(_data[key]) is not dict:
-                            _dict = [{key: _data[key]}]
-                        for _d in _dict:
-                            metric.add_metric(
-                                labels,
-                                {key: str(val) for key, val in _d.items()}
-                            )
-                    yield metric
+        with probe_caches_lock:
+            # The caches of probed pods that have expired go with them.
+            for name, (cached_pod, _) in list(probe_caches.items()):
+                if not exporter.is_active(cached_pod):
+                    del probe_caches[name]
+            cached_pod, cache = probe_caches.get(pod.name, (None, None))
+            if cached_pod is not pod:
+                cache = ExpositionCache(exporter.get_data_collector(pod),
+                                        [exporter.get_status_collector(pod)])
+                probe_caches[pod.name] = (pod, cache)
+        probe_app = make_wsgi_app(cache, lambda: pod.generation)
+        return probe_app(environ, start_response)
+    return app
 
 
 def main():
-    REGISTRY.register(HorizonExporter())
+    exporter = HorizonExporter()
+    exporter.start()
 
-    start_wsgi_server(18000)
+    # The Horizon data is rendered once per snapshot generation and served
+    # from the cache until the next refresh.
+    start_wsgi_server(18000, make_app(exporter))
     while True:
         time.sleep(1)
 
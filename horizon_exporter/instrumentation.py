@@ -0,0 +1,50 @@
+# Self-metrics of the exporters. They are registered in the default
+# registry and only cost a histogram observation per upstream call, per
+# build and per render, so they can stay enabled in production.
+from prometheus_client import Gauge, Histogram
+
+
+FAST_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1,
+                2.5)
+BYTE_BUCKETS = (1e3, 1e4, 1e5, 1e6, 1e7, 1e8)
+
+UPSTREAM_REQUEST_SECONDS = Histogram(
+    'horizon_exporter_upstream_request_seconds',
+    'Time spent waiting on upstream API requests',
+    ['endpoint', 'target'])
+UPSTREAM_RESPONSE_BYTES = Histogram(
+    'horizon_exporter_upstream_response_bytes',
+    'Size of upstream API response bodies',
+    ['endpoint', 'target'], buckets=BYTE_BUCKETS)
+PARSE_SECONDS = Histogram(
+    'horizon_exporter_parse_seconds',
+    'Time spent decoding upstream API responses',
+    ['endpoint', 'target'], buckets=FAST_BUCKETS)
+BUILD_SECONDS = Histogram(
+    'horizon_exporter_build_seconds',
+    'Time spent building metric families from the collected data',
+    ['exporter'], buckets=FAST_BUCKETS)
+SERIALIZE_SECONDS = Histogram(
+    'horizon_exporter_serialize_seconds',
+    'Time spent serializing metric families',
+    ['format'], buckets=FAST_BUCKETS)
+COMPRESS_SECONDS = Histogram(
+    'horizon_exporter_compress_seconds',
+    'Time spent compressing serialized metric families',
+    buckets=FAST_BUCKETS)
+SERIES = Gauge(
+    'horizon_exporter_series',
+    'Series emitted per metric family by the last build',
+    ['family'])
+
+
+def observe_upstream(endpoint, target, request_seconds, size, parse_seconds):
+    UPSTREAM_REQUEST_SECONDS.labels(endpoint, target).observe(request_seconds)
+    UPSTREAM_RESPONSE_BYTES.labels(endpoint, target).observe(size)
+    PARSE_SECONDS.labels(endpoint, target).observe(parse_seconds)
+
+
+def observe_build(exporter, seconds, families):
+    BUILD_SECONDS.labels(exporter).observe(seconds)
+    for metric in families:
+        SERIES.labels(metric.name).set(len(metric.samples))
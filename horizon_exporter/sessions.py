@@ -0,0 +1,163 @@
+import time
+from bisect import bisect_right
+from collections import Counter, defaultdict
+from math import fsum
+from hashlib import blake2b
+
+
+# Session fields that are aggregated, with the label used for each of them.
+SESSION_AGGREGATES = {
+    'session_state': 'state',
+    'session_protocol': 'protocol',
+    'session_type': 'type',
+    'desktop_pool_id': 'desktop_pool_id',
+    'farm_id': 'farm_id',
+    'security_gateway_id': 'gateway_id',
+}
+
+# Session states that the event counters tell apart. Any other state is
+# neither connected nor disconnected.
+CONNECTED = 1
+DISCONNECTED = 2
+SESSION_STATES = {'CONNECTED': CONNECTED, 'DISCONNECTED': DISCONNECTED}
+SESSION_EVENTS = ('start', 'end', 'disconnect', 'reconnect')
+
+# Default upper bounds, in seconds, of the session duration and idle time
+# histogram buckets.
+DURATION_BUCKETS = (300, 900, 1800, 3600, 7200, 14400, 28800, 43200, 86400,
+                    172800, 604800)
+IDLE_BUCKETS = (60, 300, 900, 1800, 3600, 7200, 14400, 28800, 86400)
+
+
+def aggregate_sessions(sessions):
+    # Group the sessions by the combination of all aggregated fields in a
+    # single pass, then fold the (few) distinct combinations into one
+    # counter per field. Only the counts are kept, so memory does not grow
+    # with the number of sessions.
+    keys = tuple(SESSION_AGGREGATES)
+    combinations = Counter(
+        tuple(map(session.get, keys)) for session in sessions)
+
+    aggregates = {key: Counter() for key in keys}
+    total = 0
+    for values, count in combinations.items():
+        total += count
+        for key, value in zip(keys, values):
+            if value is not None:
+                aggregates[key][value] += count
+
+    aggregates['total'] = total
+    aggregates['events'] = Counter(dict.fromkeys(SESSION_EVENTS, 0))
+    aggregates['duration'] = {'buckets': list(DURATION_BUCKETS), 'pools': []}
+    aggregates['idle'] = {'buckets': list(IDLE_BUCKETS), 'pools': []}
+    return aggregates
+
+
+def bucket_values(buckets, values):
+    # Turn lists of values, keyed by (desktop pool ID, farm ID), into
+    # [desktop pool ID, farm ID, cumulative bucket counts ending with the
+    # +Inf bucket, sum] entries. Each list is sorted once, and
+    # then every bucket count is a binary search, so the work per session
+    # is a single append while the sessions are read.
+    pools = []
+    for (desktop_pool_id, farm_id), observed in values.items():
+        observed.sort()
+        counts = [bisect_right(observed, bound) for bound in buckets]
+        counts.append(len(observed))
+        pools.append([desktop_pool_id, farm_id, counts, fsum(observed)])
+    return {'buckets': list(buckets), 'pools': pools}
+
+
+def session_key(session_id):
+    # A digest of the session ID that is the same in every process, so the
+    # index holds one small int per session instead of the ID string and
+    # can be written to the snapshot file.
+    return int.from_bytes(
+        blake2b(session_id.encode(), digest_size=8).digest(), 'big')
+
+
+class SessionTracker:
+    # Keeps the state of every session seen by the last fetch, and counts
+    # the sessions that started, ended, were disconnected or reconnected
+    # between two fetches by comparing their indexes. Both cost one pass
+    # over the sessions. The first fetch after a cold start only records
+    # the sessions, as there is nothing to compare it with.
+    def __init__(self, duration_buckets=DURATION_BUCKETS,
+                 idle_buckets=IDLE_BUCKETS):
+        self._duration_buckets = duration_buckets
+        self._idle_buckets = idle_buckets
+        # (index, events), replaced as a whole so that the index and the
+        # counts it has produced are always read together.
+        self.state = (None, Counter(dict.fromkeys(SESSION_EVENTS, 0)))
+
+    def restore(self, saved):
+        # Continue from an index and counts written by dump().
+        keys, states, events = saved['keys'], saved['states'], saved['events']
+        self.state = (dict(zip(keys, states)), Counter(events))
+
+    def dump(self):
+        index, events = self.state
+        if index is None:
+            return None
+        return {'keys': list(index), 'states': list(index.values()),
+                'events': events}
+
+    def aggregate(self, sessions, now=None):
+        # Aggregate the sessions like aggregate_sessions(), and in the same
+        # pass index them and sort their duration and the idle time of
+        # disconnected sessions into histograms per desktop pool and farm,
+        # labelled like the session counts.
+        if now is None:
+            now = time.time()
+        now_ms = now * 1000
+        index = {}
+        state = SESSION_STATES.get
+        durations = defaultdict(list)
+        idle_times = defaultdict(list)
+
+        def record(sessions):
+            for session in sessions:
+                session_state = state(session.get('session_state'), 0)
+                index[session_key(session['id'])] = session_state
+                pool = (session.get('desktop_pool_id') or '',
+                        session.get('farm_id') or '')
+                start_time = session.get('start_time')
+                if start_time is not None:
+                    durations[pool].append(
+                        max(0, now_ms - start_time) / 1000)
+                if session_state == DISCONNECTED:
+                    disconnected_time = session.get('disconnected_time')
+                    if disconnected_time is not None:
+                        idle_times[pool].append(
+                            max(0, now_ms - disconnected_time) / 1000)
+                yield session
+
+        aggregates = aggregate_sessions(record(sessions))
+        aggregates['events'] = self.update(index)
+        aggregates['duration'] = bucket_values(
+            self._duration_buckets, durations)
+        aggregates['idle'] = bucket_values(self._idle_buckets, idle_times)
+        return aggregates
+
+    def update(self, index):
+        previous, events = self.state
+        events = Counter(events)
+        if previous is not None:
+            started = disconnected = reconnected = 0
+            get = previous.get
+            for key, state in index.items():
+                old = get(key)
+                if old is None:
+                    started += 1
+                elif old != state:
+                    if old == CONNECTED and state == DISCONNECTED:
+                        disconnected += 1
+                    elif old == DISCONNECTED and state == CONNECTED:
+                        reconnected += 1
+            events['start'] += started
+            # Every session of the previous index not seen again has ended.
+            events['end'] += len(previous) - (len(index) - started)
+            events['disconnect'] += disconnected
+            events['reconnect'] += reconnected
+        self.state = (index, events)
+        return events
@@ -0,0 +1,22 @@
+import pytest
+
+from benchmarks.standin import StandIn
+
+
+@pytest.fixture
+def standin(monkeypatch):
+    standin = StandIn(gateways=3, connection_servers=2, sessions=20,
+                      token_ttl=30)
+    server = standin.serve()
+    url = f'http://127.0.0.1:{server.server_address[1]}'
+    for name, value in {
+        'HORIZON_API_CONNECTION_URL': url,
+        'HORIZON_API_CONNECTION_DOMAIN': 'test',
+        'HORIZON_API_CONNECTION_USERNAME': 'test',
+        'HORIZON_API_CONNECTION_PASSWORD': 'test',
+        'HORIZON_EXPORTER_POD_NAME': 'pod',
+        'HORIZON_EXPORTER_BREAKER_FAILURES': '2',
+    }.items():
+        monkeypatch.setenv(name, value)
+    yield standin
+    server.shutdown()
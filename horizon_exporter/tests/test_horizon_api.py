@@ -0,0 +1,51 @@
+import time
+
+from horizon_exporter.horizon_api import horizon_connection_server
+
+
+def test_short_lived_tokens_are_not_refreshed_in_a_loop(standin):
+    # The stand-in's 30 s tokens live shorter than the default 60 s
+    # refresh margin.
+    horizon = horizon_connection_server()
+    horizon.authenticate()
+    try:
+        time.sleep(1)
+        assert horizon.auth_counts == {'login': 1, 'refresh': 0}
+    finally:
+        horizon._refresh_timer.cancel()
+
+
+def requests_for(standin, horizon, **kwargs):
+    before = standin.counts['requests']
+    sessions = list(horizon.iter_inventory_sessions(**kwargs))
+    return sessions, standin.counts['requests'] - before
+
+
+def test_paging_stops_when_no_more_records(standin):
+    horizon = horizon_connection_server()
+    horizon.authenticate()
+    try:
+        # The second page is full, but the last one.
+        sessions, requests = requests_for(standin, horizon, size=10,
+                                          prefetch=1)
+        assert len(sessions) == 20
+        assert requests == 2
+    finally:
+        horizon.close()
+
+
+def test_paging_stops_on_short_page(standin, monkeypatch):
+    page = standin.page
+    monkeypatch.setattr(standin, 'page',
+                        lambda number, size: (page(number, size)[0], True))
+    standin.sessions = 25
+    horizon = horizon_connection_server()
+    horizon.authenticate()
+    try:
+        sessions, requests = requests_for(standin, horizon, size=10,
+                                          prefetch=1)
+        assert [session['id'] for session in sessions] == [
+            session['id'] for session in page(1, 25)[0]]
+        assert requests == 3
+    finally:
+        horizon.close()
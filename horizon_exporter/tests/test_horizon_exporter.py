@@ -0,0 +1,154 @@
+import gzip
+import re
+import threading
+import time
+
+from prometheus_client import CollectorRegistry, Counter
+
+from horizon_exporter.horizon_exporter import HorizonExporter, make_app
+
+
+def test_error_response_keeps_last_good_data(standin):
+    exporter = HorizonExporter()
+    exporter.refresh()
+    pod = exporter.probe('pod')
+    gateways = pod.snapshot['data']['gateways']
+    assert len(gateways) == 3
+
+    standin.failing.add('/rest/monitor/v3/gateways')
+    for _ in range(2):
+        exporter.refresh()
+
+    success, timestamp, circuit_open = pod.snapshot['status']['gateways']
+    assert not success
+    assert timestamp is not None
+    assert circuit_open
+    assert pod.snapshot['data']['gateways'] is gateways
+
+    samples = {
+        (family.name, sample.labels.get('endpoint')): sample.value
+        for family in exporter.collect() for sample in family.samples}
+    assert samples['horizon_exporter_upstream_up', 'gateways'] == 0
+    assert samples['horizon_exporter_upstream_up', 'sessions'] == 1
+    assert samples['horizon_exporter_circuit_open', 'gateways'] == 1
+
+
+def test_slow_endpoint_is_served_once_it_answers(standin, monkeypatch):
+    # Three pages take longer than the sessions timeout, though each page
+    # is well within it.
+    standin.sessions = 3000
+    standin.page_latency = 0.4
+    monkeypatch.setenv('HORIZON_EXPORTER_TIMEOUT_SESSIONS', '0.6')
+    exporter = HorizonExporter()
+    pod = exporter.probe('pod')
+    assert not pod.snapshot['status']['sessions'][0]
+    assert pod.snapshot['data']['sessions']['total'] == 0
+
+    pod.pending['sessions'].result(timeout=5)
+    deadline = time.monotonic() + 5
+    while (not pod.snapshot['status']['sessions'][0]
+           and time.monotonic() < deadline):
+        time.sleep(0.01)
+    assert pod.snapshot['status']['sessions'][0]
+    assert pod.snapshot['data']['sessions']['total'] == 3000
+
+
+def test_expired_probe_pod_stops_refreshing_tokens(standin, monkeypatch):
+    monkeypatch.setenv('HORIZON_EXPORTER_PROBE_TARGETS', 'http://127.0.0.1:*')
+    monkeypatch.setenv('HORIZON_EXPORTER_PROBE_EXPIRY', '0')
+    exporter = HorizonExporter()
+    target = exporter.probe('pod').horizon._url
+
+    pod = exporter.probe(target)
+    assert pod.snapshot is not None
+    assert pod.horizon._refresh_timer is not None
+    assert exporter.is_active(pod)
+
+    exporter._active_pods()
+    assert not exporter.is_active(pod)
+    assert pod.horizon._refresh_timer is None
+    pod.horizon._refresh_in_background()
+    assert pod.horizon.auth_counts['refresh'] == 0
+
+
+def test_probe_pod_is_not_queued_behind_configured_pods(standin, monkeypatch):
+    monkeypatch.setenv('HORIZON_EXPORTER_PROBE_TARGETS', 'http://127.0.0.1:*')
+    monkeypatch.setenv('HORIZON_EXPORTER_FETCH_WORKERS', '1')
+    exporter = HorizonExporter()
+    target = exporter.probe('pod').horizon._url
+
+    # Hold the only shared worker with a slow session fetch.
+    standin.page_latency = 2
+    threading.Thread(target=exporter.refresh, daemon=True).start()
+    time.sleep(0.1)
+    standin.page_latency = 0
+
+    start = time.monotonic()
+    pod = exporter.probe(target, time.monotonic() + 1)
+    assert time.monotonic() - start < 1
+    assert all(success for success, _, _ in pod.snapshot['status'].values())
+
+
+def scrape(app, **environ):
+    responses = []
+    body = b''.join(app(environ, lambda status, headers: responses.append(
+        (status, dict(headers)))))
+    status, headers = responses[0]
+    if headers.get('Content-Encoding') == 'gzip':
+        body = gzip.decompress(body)
+    return body.decode(), headers
+
+
+def scraped(body):
+    return float(re.search(r'^test_scrapes_total (\S+)$', body, re.M)[1])
+
+
+def test_cached_scrape_renders_live_metrics_afresh(standin):
+    exporter = HorizonExporter()
+    exporter.refresh()
+    registry = CollectorRegistry(auto_describe=False)
+    counter = Counter('test_scrapes', 'Scrapes', registry=registry)
+    app = make_app(exporter, registry)
+
+    for environ in ({}, {'HTTP_ACCEPT_ENCODING': 'gzip'},
+                    {'HTTP_ACCEPT': 'application/openmetrics-text'}):
+        first, first_headers = scrape(app, **environ)
+        counter.inc()
+        time.sleep(0.01)
+        second, second_headers = scrape(app, **environ)
+
+        assert 'horizon_gateway_active_connection_count{' in second
+        assert scraped(first) + 1 == scraped(second)
+        assert first_headers['ETag'] == second_headers['ETag']
+        ages = [line for line in (first, second)
+                for line in line.splitlines()
+                if line.startswith('horizon_exporter_snapshot_age_seconds')]
+        assert len(set(ages)) == len(ages)
+        if 'openmetrics' in environ.get('HTTP_ACCEPT', ''):
+            assert second.count('# EOF') == 1
+            assert second.endswith('# EOF\n')
+
+
+def test_unchanged_snapshot_is_not_modified(standin, monkeypatch):
+    monkeypatch.setenv('HORIZON_EXPORTER_PROBE_TARGETS', 'http://127.0.0.1:*')
+    exporter = HorizonExporter()
+    exporter.refresh()
+    target = exporter.probe('pod').horizon._url
+    app = make_app(exporter, CollectorRegistry(auto_describe=False))
+
+    for environ in ({}, {'QUERY_STRING': f'target={target}'}):
+        for encoding in ('', 'gzip'):
+            environ = dict(environ, HTTP_ACCEPT_ENCODING=encoding)
+            _, headers = scrape(app, **environ)
+            responses = []
+            body = b''.join(app(
+                dict(environ, HTTP_IF_NONE_MATCH=headers['ETag']),
+                lambda status, headers: responses.append(status)))
+            assert responses == ['304 Not Modified']
+            assert body == b''
+
+    # A new snapshot, with new gateway counts, is served in full again.
+    _, headers = scrape(app)
+    exporter.refresh()
+    body, _ = scrape(app, HTTP_IF_NONE_MATCH=headers['ETag'])
+    assert 'horizon_gateway_active_connection_count{' in body
@@ -0,0 +1,34 @@
+import xmltodict
+from prometheus_client.metrics_core import CounterMetricFamily
+
+from benchmarks.data import make_uag_stats_xml
+from horizon_exporter.horizon_exporter import METRICS, compile_metrics
+from horizon_exporter.uag_exporter import UAGExporter
+
+
+def test_counter_samples_have_total_suffix(monkeypatch):
+    monkeypatch.setitem(METRICS, 'gateways', {
+        'requests': (CounterMetricFamily, 'horizon_gateway_requests',
+                     'Requests')})
+    [(_, factory, name, documentation, labels, fill)] = [
+        entry for entry in compile_metrics() if entry[0] == 'gateways']
+    metric = factory(name, documentation, labels=labels)
+    fill(metric, [{'name': 'gw', 'requests': 3}], 'pod')
+    [sample] = metric.samples
+    assert sample.name == 'horizon_gateway_requests_total'
+    assert sample.value == 3
+
+
+def test_uag_extractor_builds_the_same_families_as_xmltodict():
+    exporter = UAGExporter()
+    # A single protocol element is a dict rather than a list to xmltodict,
+    # which the extractor must reproduce.
+    for protocols in (['PCOIP', 'BLAST', 'TUNNEL'], ['BLAST'], []):
+        doc = make_uag_stats_xml(protocols).encode()
+        expected = exporter.collect_data(xmltodict.parse(doc))
+        assert exporter.collect_data(exporter.extract(doc)) == expected
+        if protocols:
+            [sessions] = [family for family in expected
+                          if family.name == 'horizon_uag_protocol_sessions']
+            assert {sample.labels['name'] for sample in sessions.samples} \
+                == set(protocols)
@@ -0,0 +1,103 @@
+import json
+
+from horizon_exporter.horizon_exporter import METRICS, compile_metrics
+from horizon_exporter.sessions import SessionTracker
+
+
+def sessions(**states):
+    return [{'id': session_id, 'session_state': state}
+            for session_id, state in states.items()]
+
+
+def events(tracker, **states):
+    return dict(tracker.aggregate(sessions(**states))['events'])
+
+
+def test_histograms_are_labelled_like_session_counts():
+    now = 1000000.0
+    sessions = [
+        {'id': 'a', 'session_state': 'CONNECTED', 'desktop_pool_id': 'x',
+         'start_time': (now - 100) * 1000},
+        {'id': 'b', 'session_state': 'DISCONNECTED', 'farm_id': 'x',
+         'start_time': (now - 7200) * 1000,
+         'disconnected_time': (now - 30) * 1000},
+    ]
+    aggregates = SessionTracker().aggregate(sessions, now=now)
+
+    families = {}
+    for list_key, factory, name, documentation, labels, fill in \
+            compile_metrics():
+        if list_key == 'sessions':
+            metric = factory(name, documentation, labels=labels)
+            fill(metric, aggregates, 'pod')
+            families[name] = metric
+
+    pool_labels = set(METRICS['sessions']['desktop_pool_id'][3])
+    counts = {tuple(sample.labels.items())
+              for sample in families['horizon_session_desktop_pool_count']
+              .samples}
+    assert counts == {(('pod', 'pod'), ('desktop_pool_id', 'x'))}
+
+    durations = {
+        (sample.labels['desktop_pool_id'], sample.labels['farm_id']):
+            sample.value
+        for sample in families['horizon_session_duration_seconds'].samples
+        if sample.name.endswith('_sum')}
+    assert durations == {('x', ''): 100, ('', 'x'): 7200}
+    assert pool_labels <= set(
+        families['horizon_session_duration_seconds'].samples[0].labels)
+
+    [idle] = [sample for sample in
+              families['horizon_session_idle_seconds'].samples
+              if sample.name.endswith('_count')]
+    assert idle.labels == {'pod': 'pod', 'desktop_pool_id': '',
+                           'farm_id': 'x'}
+    assert idle.value == 1
+
+
+def test_first_fetch_only_records_sessions():
+    tracker = SessionTracker()
+    assert events(tracker, a='CONNECTED', b='DISCONNECTED') == {
+        'start': 0, 'end': 0, 'disconnect': 0, 'reconnect': 0}
+
+
+def test_started_and_ended_sessions_are_counted():
+    tracker = SessionTracker()
+    events(tracker, a='CONNECTED', b='CONNECTED', c='DISCONNECTED')
+    # b and c ended, d, e and f started, a stayed.
+    assert events(tracker, a='CONNECTED', d='CONNECTED', e='CONNECTED',
+                  f='PENDING') == {
+        'start': 3, 'end': 2, 'disconnect': 0, 'reconnect': 0}
+    # Everything ended.
+    assert events(tracker) == {
+        'start': 3, 'end': 6, 'disconnect': 0, 'reconnect': 0}
+
+
+def test_disconnects_and_reconnects_are_counted():
+    tracker = SessionTracker()
+    events(tracker, a='CONNECTED', b='DISCONNECTED', c='CONNECTED',
+           d='PENDING')
+    # a disconnects, b reconnects, c is unchanged, and d leaves a state
+    # that is neither.
+    assert events(tracker, a='DISCONNECTED', b='CONNECTED', c='CONNECTED',
+                  d='CONNECTED') == {
+        'start': 0, 'end': 0, 'disconnect': 1, 'reconnect': 1}
+    assert events(tracker, a='CONNECTED', b='CONNECTED', c='DISCONNECTED',
+                  d='CONNECTED') == {
+        'start': 0, 'end': 0, 'disconnect': 2, 'reconnect': 2}
+
+
+def test_counters_continue_across_restore():
+    tracker = SessionTracker()
+    assert tracker.dump() is None
+    events(tracker, a='CONNECTED', b='DISCONNECTED')
+    counts = events(tracker, a='DISCONNECTED', c='CONNECTED')
+
+    restored = SessionTracker()
+    restored.restore(json.loads(json.dumps(tracker.dump())))
+    assert dict(restored.state[1]) == counts
+    # The restored index is compared with the next fetch like the
+    # original one, so no session is counted as started again.
+    assert events(restored, a='CONNECTED', c='CONNECTED', d='CONNECTED') \
+        == events(tracker, a='CONNECTED', c='CONNECTED', d='CONNECTED') \
+        == {'start': 2, 'end': 1, 'disconnect': 1, 'reconnect': 1}
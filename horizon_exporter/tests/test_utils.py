@@ -0,0 +1,84 @@
+import asyncio
+import json
+
+import pytest
+
+from horizon_exporter.utils import (
+    MIN_SCRAPE_TIMEOUT, CircuitBreaker, CircuitOpenError, get_scrape_timeout,
+    iter_json_array)
+
+
+def fail():
+    raise ConnectionError
+
+
+def test_breaker_opens_and_closes_after_trial():
+    breaker = CircuitBreaker(threshold=2, backoff=0)
+    for _ in range(2):
+        with pytest.raises(ConnectionError):
+            breaker.call(fail)
+    assert breaker.state == CircuitBreaker.OPEN
+
+    assert breaker.call(lambda: 1) == 1
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_cancelled_trial_does_not_leave_breaker_half_open():
+    breaker = CircuitBreaker(threshold=1, backoff=0)
+    with pytest.raises(ConnectionError):
+        breaker.call(fail)
+
+    async def cancelled_trial():
+        task = asyncio.create_task(
+            breaker.call_async(asyncio.sleep, 10))
+        await asyncio.sleep(0)
+        assert breaker.state == CircuitBreaker.HALF_OPEN
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(cancelled_trial())
+    assert breaker.state == CircuitBreaker.OPEN
+    assert breaker.allow()
+
+
+def test_open_breaker_rejects_calls():
+    breaker = CircuitBreaker(threshold=1, backoff=60)
+    with pytest.raises(ConnectionError):
+        breaker.call(fail)
+    with pytest.raises(CircuitOpenError):
+        breaker.call(lambda: 1)
+
+
+def test_scrape_timeout_is_never_zero():
+    assert get_scrape_timeout('10', 5) == 5
+    assert get_scrape_timeout('3', 5) == 2.5
+    assert get_scrape_timeout('0.5', 5) == MIN_SCRAPE_TIMEOUT
+    assert get_scrape_timeout(None, 5) == 5
+
+
+def chunked(text, size):
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+
+def test_json_array_values_split_across_chunks():
+    items = [2.5, -10, 1e-3, 'a,]b', {'c': [1, ', ]']}, None, True, '']
+    text = ' [' + ', '.join(json.dumps(item) for item in items) + '] \n'
+    for size in range(1, len(text) + 1):
+        assert list(iter_json_array(chunked(text, size))) == items
+
+    # A number cut right after its decimal point is not handed out early.
+    assert list(iter_json_array(['[1, 2.', '75]'])) == [1, 2.75]
+
+
+def test_empty_json_array():
+    for chunks in (['[]'], ['[', ']'], [' ', '[ ', '\n]']):
+        assert list(iter_json_array(chunks)) == []
+
+
+def test_truncated_json_array():
+    for text in ('', '[', '[1, 2', '[1, "a,]', '[{"a": 1}, {"b"'):
+        with pytest.raises(ValueError):
+            list(iter_json_array(chunked(text, 3)))
+    with pytest.raises(ValueError):
+        list(iter_json_array(['{"a": 1}']))
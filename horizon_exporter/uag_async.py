@@ -0,0 +1,251 @@
+import asyncio
+import gzip
+import hashlib
+import logging
+import os
+import time
+from urllib.parse import urlsplit
+
+import aiohttp
+from aiohttp import web
+
+# Prometheus specific imports
+from prometheus_client import REGISTRY
+from prometheus_client.exposition import choose_encoder, gzip_accepted
+
+# Exposition
+from .exposition import ExpositionCache
+
+# Self-metrics
+from .instrumentation import observe_upstream
+
+# UAG metric definitions
+from .uag_exporter import (
+    UAGAppliance, _ApplianceCollector, get_target_groups)
+
+# Utils
+from .utils import (
+    CircuitOpenError, ExpiringLRU, get_env_breaker, get_env_float,
+    get_scrape_timeout)
+
+
+logger = logging.getLogger(__name__)
+
+
+class horizon_uag_async:
+    # Counterpart of horizon_api.horizon_uag for the event loop. All
+    # appliances share one connection pool, and at most `concurrency`
+    # stats documents are fetched at a time.
+    def __init__(self, parse, concurrency=None, timeout=None):
+        username = os.environ['HORIZON_API_GATEWAY_USERNAME']
+        password = os.environ['HORIZON_API_GATEWAY_PASSWORD']
+        self._auth = aiohttp.BasicAuth(username, password)
+        self._parse = parse
+
+        if concurrency is None:
+            concurrency = int(os.environ.get(
+                'HORIZON_API_GATEWAY_CONCURRENCY', 64))
+        if timeout is None:
+            timeout = get_env_float('HORIZON_API_GATEWAY_TIMEOUT', 10)
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.max_targets = int(os.environ.get(
+            'HORIZON_API_GATEWAY_MAX_TARGETS', 128))
+        self.idle_timeout = get_env_float('HORIZON_API_GATEWAY_IDLE_TIMEOUT',
+                                          300)
+        self._semaphore = None
+        self._session = None
+
+    async def start(self):
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+        self._session = aiohttp.ClientSession(
+            auth=self._auth,
+            connector=aiohttp.TCPConnector(
+                limit=self.concurrency,
+                keepalive_timeout=self.idle_timeout))
+
+    async def close(self):
+        await self._session.close()
+
+    async def _get_xml(self, url, endpoint):
+        async with self._semaphore:
+            start = time.perf_counter()
+            async with self._session.get(f"{url}{endpoint}") as response:
+                response.raise_for_status()
+                content = await response.read()
+            request_seconds = time.perf_counter() - start
+            data = self._parse(content)
+            observe_upstream(endpoint, urlsplit(url).netloc,
+                             request_seconds, len(content),
+                             time.perf_counter() - start - request_seconds)
+        return data, hashlib.sha1(content).hexdigest()
+
+    async def get_monitor(self, host, timeout=None):
+        # The timeout covers waiting for a free slot as well as the request,
+        # so a probe never outlives it because of other targets.
+        url = host if "://" in host else f"https://{host}"
+        return await asyncio.wait_for(
+            self._get_xml(url, "/rest/v1/monitor/stats"),
+            self.timeout if timeout is None else timeout)
+
+
+def _cached_response(request, cache, generation, registry=None, live=None):
+    body, headers = cache.get(
+        generation,
+        request.headers.get('Accept'),
+        request.headers.get('Accept-Encoding'),
+        registry, live, request.headers.get('If-None-Match'))
+
+    if body is None:
+        return web.Response(status=304, headers=headers)
+    return web.Response(body=body, headers=headers)
+
+
+def _registry_response(request, registry):
+    encoder, content_type = choose_encoder(request.headers.get('Accept'))
+    body = encoder(registry)
+    headers = {'Content-Type': content_type}
+    if gzip_accepted(request.headers.get('Accept-Encoding')):
+        body = gzip.compress(body)
+        headers['Content-Encoding'] = 'gzip'
+    return web.Response(body=body, headers=headers)
+
+
+async def _fetch(uag, appliance, timeout=None):
+    # Update the snapshot of an appliance and return the digest of its
+    # stats document, or None when the fetch failed.
+    try:
+        uag_data, digest = await appliance.breaker.call_async(
+            uag.get_monitor, appliance.target, timeout)
+    except CircuitOpenError:
+        logger.debug("Circuit open for UAG %s", appliance.target)
+        uag_data, digest = None, None
+    except Exception:
+        logger.exception("Failed to fetch UAG stats from %s",
+                         appliance.target)
+        uag_data, digest = None, None
+    appliance.update(uag_data)
+    return digest
+
+
+async def _poll_fleet(fleet, uag):
+    # Same cadence as UAGFleet's poller: an appliance whose previous fetch
+    # is still running is skipped by the next round.
+    tasks = {}
+    try:
+        while True:
+            if fleet.snapshot_file:
+                await asyncio.to_thread(fleet._save_snapshot)
+            for target, appliance in fleet.appliances.items():
+                task = tasks.get(target)
+                if task is None or task.done():
+                    tasks[target] = asyncio.create_task(
+                        _fetch(uag, appliance, fleet.timeout))
+            await asyncio.sleep(fleet.interval)
+    finally:
+        for task in tasks.values():
+            task.cancel()
+
+
+def make_app(uag, exporter, fleet=None, groups=None, registry=REGISTRY):
+    if groups is None:
+        groups = get_target_groups()
+    breaker = get_env_breaker('HORIZON_API_GATEWAY')
+    probes = ExpiringLRU(lambda target: UAGAppliance(target, breaker()),
+                         uag.max_targets, uag.idle_timeout)
+    caches = ExpiringLRU(lambda host: ExpositionCache(),
+                         uag.max_targets, uag.idle_timeout)
+    fleet_cache = fleet.get_cache(registry) if fleet else None
+    scrape_offset = get_env_float(
+        'HORIZON_API_GATEWAY_SCRAPE_TIMEOUT_OFFSET', 0.5)
+
+    def get_timeout(request):
+        return get_scrape_timeout(
+            request.headers.get('X-Prometheus-Scrape-Timeout-Seconds'),
+            uag.timeout, scrape_offset)
+
+    # A probe that Prometheus gives up on is cancelled along with its
+    # upstream requests once the scraper disconnects. One that runs out of
+    # time serves the last stats of its appliances and marks them as down.
+
+    async def probe(request, target):
+        appliance = probes.get(target)
+        digest = await _fetch(uag, appliance, get_timeout(request))
+        if digest is not None:
+            collector = _ApplianceCollector(exporter, [appliance],
+                                            ages=False)
+            generation = digest
+        else:
+            collector = _ApplianceCollector(exporter, [appliance])
+            generation = collector.generation
+        return _cached_response(request, caches.get(target), generation,
+                                collector.data, [collector.status])
+
+    async def probe_batch(request, targets):
+        timeout = get_timeout(request)
+        appliances = []
+        fetches = []
+        for target in dict.fromkeys(targets):
+            appliance = fleet.get(target) if fleet else None
+            if appliance is None:
+                appliance = probes.get(target)
+                fetches.append(_fetch(uag, appliance, timeout))
+            appliances.append(appliance)
+        await asyncio.gather(*fetches)
+
+        collector = _ApplianceCollector(exporter, appliances, ['target'])
+        return _cached_response(request, caches.get(tuple(targets)),
+                                collector.generation, collector.data,
+                                [collector.status])
+
+    async def handle(request):
+        if 'group' in request.query:
+            targets = groups.get(request.query['group'].lower())
+            if targets is None:
+                return web.Response(status=404, text="Unknown group\n")
+            return await probe_batch(request, targets)
+
+        targets = request.query.getall('target', [])
+        if len(targets) > 1:
+            return await probe_batch(request, targets)
+
+        if targets:
+            appliance = fleet.get(targets[0]) if fleet else None
+            if appliance is None:
+                return await probe(request, targets[0])
+            collector = fleet.get_collector(appliance)
+            return _cached_response(request, caches.get(targets[0]),
+                                    collector.generation, collector.data,
+                                    [collector.status])
+
+        if request.path == '/metrics':
+            if fleet:
+                return _cached_response(request, fleet_cache,
+                                        fleet.generation)
+            return _registry_response(request, registry)
+
+        return web.Response(status=404, text="No target defined\n")
+
+    async def on_startup(app):
+        await uag.start()
+        if fleet:
+            if fleet.snapshot_file:
+                fleet.load_snapshot()
+            app['poller'] = asyncio.create_task(_poll_fleet(fleet, uag))
+
+    async def on_cleanup(app):
+        if 'poller' in app:
+            app['poller'].cancel()
+        await uag.close()
+
+    app = web.Application()
+    app.router.add_get('/{tail:.*}', handle)
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
+    return app
+
+
+def run(exporter, fleet=None, port=19000):
+    uag = horizon_uag_async(parse=exporter.extract)
+    web.run_app(make_app(uag, exporter, fleet), port=port,
+                handler_cancellation=True, print=None)
@@ -1,252 +1,757 @@
-from http.server import HTTPServer
+from http.server import ThreadingHTTPServer
+import logging
+import os
+import threading
+import time
 import urllib.parse
+from concurrent.futures import ThreadPoolExecutor, TimeoutError, wait
 
 # Prometheus specific imports
 from prometheus_client import REGISTRY, MetricsHandler
 from prometheus_client.metrics_core import (
     GaugeMetricFamily, InfoMetricFamily, CounterMetricFamily)
 
+# Exposition
+from .exposition import ExpositionCache, FunctionCollector, send_cached
+
+# Self-metrics
+from .instrumentation import observe_build
+
 # Horizon API Specific imports
 from .horizon_api import horizon_uag
 
 # Utils
-from .utils import get_nested_item
+from .utils import (
+    CircuitBreaker, CircuitOpenError, ExpiringLRU, compile_path,
+    compile_xml_extractor, get_env_breaker, get_env_float, get_env_list,
+    get_scrape_timeout, read_snapshot_file, write_snapshot_file)
+
+
+logger = logging.getLogger(__name__)
+
+# Layout version of the fleet snapshot file.
+SNAPSHOT_VERSION = 1
+
+# Metric definitions. 'path' locates the value in the stats document,
+# 'label' is either the info label used for a plain value or, for gauges,
+# the path of a label value. 'rlabel' and 'rdata' pick the label and the
+# value out of each element of a repeated node.
+METRICS = [{
+    'path': ['overAllStatus'],
+    'type': InfoMetricFamily,
+    'name': 'horizon_uag_status',
+    'documentation': 'VMware UAG Overall Status',
+    'labels': ['status'],
+}, {
+    'path': ['uagVersion'],
+    'label': 'version',
+    'type': InfoMetricFamily,
+    'name': 'horizon_uag_version',
+    'documentation': 'VMware UAG Version',
+    'labels': ['version'],
+}, {
+    'path': ['sessionCount'],
+    'type': GaugeMetricFamily,
+    'name': 'horizon_uag_session_count',
+    'documentation': 'VMware UAG Session Count',
+    'labels': [],
+}, {
+    'path': ['authenticatedSessionCount'],
+    'type': GaugeMetricFamily,
+    'name': 'horizon_uag_authenicated_session_count',
+    'documentation': 'VMware UAG Authenticated Session Count',
+    'labels': [],
+}, {
+    'path': ['authenticatedViewSessionCount'],
+    'type': GaugeMetricFamily,
+    'name': 'horizon_uag_authenicated_view_session_count',
+    'documentation': 'VMware UAG Authenticated View Session Count',
+    'labels': [],
+}, {
+    'path': ['openIncomingConnectionCount'],
+    'type': GaugeMetricFamily,
+    'name': 'horizon_uag_open_incoming_connection_count',
+    'documentation': 'VMware UAG Open Incoming Connection Count',
+    'labels': [],
+}, {
+    'path': ['highWaterMark'],
+    'type': GaugeMetricFamily,
+    'name': 'horizon_uag_connection_high_water_mark',
+    'documentation': 'VMware UAG Connection High Water Mark',
+    'labels': [],
+}, {
+    'path': ['viewEdgeServiceStats', 'backendStatus'],
+    'type': InfoMetricFamily,
+    'name': 'horizon_uag_backend_status',
+    'documentation': 'VMware UAG Backend Status',
+    'labels': ['reason', 'status'],
+}, {
+    'path': ['viewEdgeServiceStats', 'edgeServiceStatus'],
+    'type': InfoMetricFamily,
+    'name': 'horizon_uag_edge_service_status',
+    'documentation': 'VMware UAG Edge Service Status',
+    'labels': ['status'],
+}, {
+    'path': ['viewEdgeServiceStats', 'edgeServiceSessionStats',
+             'totalSessions'],
+    'label': ['viewEdgeServiceStats', 'edgeServiceSessionStats',
+              'identifier'],
+    'type': GaugeMetricFamily,
+    'name': 'horizon_uag_edge_service_total_sessions',
+    'documentation': 'VMware UAG Edge Service Total Sessions',
+    'labels': ['identifier'],
+}, {
+    'path': ['viewEdgeServiceStats', 'edgeServiceSessionStats',
+             'authenticatedSessions'],
+    'label': ['viewEdgeServiceStats', 'edgeServiceSessionStats',
+              'identifier'],
+    'type': GaugeMetricFamily,
+    'name': 'horizon_uag_edge_service_authenticated_sessions',
+    'documentation': 'VMware UAG Edge Service Authenticated Sessions',
+    'labels': ['identifier'],
+}, {
+    'path': ['viewEdgeServiceStats', 'edgeServiceSessionStats',
+             'unauthenticatedSessions'],
+    'label': ['viewEdgeServiceStats', 'edgeServiceSessionStats',
+              'identifier'],
+    'type': GaugeMetricFamily,
+    'name': 'horizon_uag_edge_service_unauthenticated_sessions',
+    'documentation': 'VMware UAG Edge Service Unauthenticated Sessions',
+    'labels': ['identifier'],
+}, {
+    'path': ['viewEdgeServiceStats', 'edgeServiceSessionStats',
+             'failedLoginAttempts'],
+    'label': ['viewEdgeServiceStats', 'edgeServiceSessionStats',
+              'identifier'],
+    'type': GaugeMetricFamily,
+    'name': 'horizon_uag_edge_service_failed_login_attempts',
+    'documentation': 'VMware UAG Edge Service Failed Login Attempts',
+    'labels': ['identifier'],
+}, {
+    'path': ['viewEdgeServiceStats', 'edgeServiceSessionStats',
+             'userCount'],
+    'label': ['viewEdgeServiceStats', 'edgeServiceSessionStats',
+              'identifier'],
+    'type': GaugeMetricFamily,
+    'name': 'horizon_uag_edge_service_user_count',
+    'documentation': 'VMware UAG Edge Service User Count',
+    'labels': ['identifier'],
+}, {
+    'path': ['viewEdgeServiceStats', 'protocol'],
+    'rlabel': ['@name'],
+    'rdata': 'status',
+    'type': InfoMetricFamily,
+    'name': 'horizon_uag_protocol_status',
+    'documentation': 'VMware UAG Protocol Status',
+    'labels': ['name', 'reason', 'status'],
+}, {
+    'path': ['viewEdgeServiceStats', 'protocol'],
+    'rlabel': ['@name'],
+    'rdata': 'sessions',
+    'type': GaugeMetricFamily,
+    'name': 'horizon_uag_protocol_sessions',
+    'documentation': 'VMware UAG Protocol Sessions',
+    'labels': ['name'],
+}, {
+    'path': ['viewEdgeServiceStats', 'protocol'],
+    'rlabel': ['@name'],
+    'rdata': 'maxSessions',
+    'type': GaugeMetricFamily,
+    'name': 'horizon_uag_protocol_max_sessions',
+    'documentation': 'VMware UAG Protocol Max Sessions',
+    'labels': ['name'],
+}, {
+    'path': ['viewEdgeServiceStats', 'protocol'],
+    'rlabel': ['@name'],
+    'rdata': 'unrecognizedRequestsCount',
+    'type': GaugeMetricFamily,
+    'name': 'horizon_uag_protocol_unrecognized_requests_count',
+    'documentation': 'VMware UAG Protocol Unrecognized Requests Count',
+    'labels': ['name'],
+}, {
+    'path': ['applianceStats', 'freeMemoryMb'],
+    'type': GaugeMetricFamily,
+    'name': 'horizon_uag_appliance_mem_free',
+    'documentation': 'VMware UAG Appliance Free Memory in Mb',
+    'labels': [],
+}, {
+    'path': ['applianceStats', 'totalMemoryMb'],
+    'type': GaugeMetricFamily,
+    'name': 'horizon_uag_appliance_mem_total',
+    'documentation': 'VMware UAG Appliance Total Memory in Mb',
+    'labels': [],
+}, {
+    'path': ['applianceStats', 'totalCpuLoadPercent'],
+    'type': GaugeMetricFamily,
+    'name': 'horizon_uag_appliance_cpu_load',
+    'documentation': 'VMware UAG Appliance Total CPU Load in Percent',
+    'labels': [],
+}]
+
+
+def _compile_metric(definition):
+    # Build the label names and a filler for one definition, so that
+    # collect() does not have to inspect the definition on every scrape.
+    get = compile_path(definition['path'])
+    factory = definition['type']
+    label = definition.get('label')
+    rlabel = definition.get('rlabel', [])
+    rdata = definition.get('rdata')
+
+    if factory is InfoMetricFamily:
+        def add(metric, labels, _d):
+            if type(_d) is not dict:
+                _d = {label: _d}
+            metric.add_metric(
+                labels, {key: str(val) for key, val in _d.items()})
+    else:
+        convert = int if factory is CounterMetricFamily else float
+
+        def add(metric, labels, _d):
+            metric.add_metric(labels, convert(_d))
+
+    get_label = None
+    if factory is GaugeMetricFamily and label is not None:
+        get_label = compile_path(label)
 
+    def fill(metric, uag_data, prefix=()):
+        try:
+            _data = get(uag_data)
+        except KeyError:
+            return False
 
-UAG = horizon_uag()
+        if type(_data) is not list:
+            _data = [_data]
+
+        base = list(prefix)
+        if get_label is not None:
+            base.append(get_label(uag_data))
+
+        for _d in _data:
+            labels = base + [_d[_l] for _l in rlabel]
+            if rdata is not None:
+                _d = _d[rdata]
+            add(metric, labels, _d)
+        return True
+
+    return (factory, definition['name'], definition['documentation'],
+            definition['labels'], fill)
+
+
+def compile_metrics():
+    return [_compile_metric(definition) for definition in METRICS]
+
+
+def compile_extractor():
+    # Parse only the parts of the stats document that some metric reads.
+    paths = []
+    for definition in METRICS:
+        paths.append(definition['path'])
+        if (definition['type'] is GaugeMetricFamily
+                and definition.get('label') is not None):
+            paths.append(definition['label'])
+    return compile_xml_extractor(
+        [['accessPointStatusAndStats'] + path for path in paths])
 
 
 class UAGExporter:
-    def _create_metric_list(self):
-
-        self._label_names = []
-
-        self.metric_list = [{
-            'path': ['overAllStatus'],
-            'metric': InfoMetricFamily(
-                'horizon_uag_status',
-                'VMware UAG Overall Status',
-                labels=self._label_names + ['status']),
-        }, {
-            'path': ['uagVersion'],
-            'label': 'version',
-            'metric': InfoMetricFamily(
-                'horizon_uag_version',
-                'VMware UAG Version',
-                labels=self._label_names + ['version']),
-        }, {
-            'path': ['sessionCount'],
-            'metric': GaugeMetricFamily(
-                'horizon_uag_session_count',
-                'VMware UAG Session Count',
-                labels=self._label_names)
-        }, {
-            'path': ['authenticatedSessionCount'],
-            'metric': GaugeMetricFamily(
-                'horizon_uag_authenicated_session_count',
-                'VMware UAG Authenticated Session Count',
-                labels=self._label_names)
-        }, {
-            'path': ['authenticatedViewSessionCount'],
-            'metric': GaugeMetricFamily(
-                'horizon_uag_authenicated_view_session_count',
-                'VMware UAG Authenticated View Session Count',
-                labels=self._label_names)
-        }, {
-            'path': ['openIncomingConnectionCount'],
-            'metric': GaugeMetricFamily(
-                'horizon_uag_open_incoming_connection_count',
-                'VMware UAG Open Incoming Connection Count',
-                labels=self._label_names)
-        }, {
-            'path': ['highWaterMark'],
-            'metric': GaugeMetricFamily(
-                'horizon_uag_connection_high_water_mark',
-                'VMware UAG Connection High Water Mark',
-                labels=self._label_names)
-        }, {
-            'path': ['viewEdgeServiceStats', 'backendStatus'],
-            'metric': InfoMetricFamily(
-                'horizon_uag_backend_status',
-                'VMware UAG Backend Status',
-                labels=self._label_names + ['reason', 'status']),
-        }, {
-            'path': ['viewEdgeServiceStats', 'edgeServiceStatus'],
-            'metric': InfoMetricFamily(
-                'horizon_uag_edge_service_status',
-                'VMware UAG Edge Service Status',
-                labels=self._label_names + ['status']),
-        }, {
-            'path': ['viewEdgeServiceStats', 'edgeServiceSessionStats',
-                     'totalSessions'],
-            'label': ['viewEdgeServiceStats', 'edgeServiceSessionStats',
-                      'identifier'],
-            'metric': GaugeMetricFamily(
-                'horizon_uag_edge_service_total_sessions',
-                'VMware UAG Edge Service Total Sessions',
-                labels=self._label_names + ['identifier'])
-        }, {
-            'path': ['viewEdgeServiceStats', 'edgeServiceSessionStats',
-                     'authenticatedSessions'],
-            'label': ['viewEdgeServiceStats', 'edgeServiceSessionStats',
-                      'identifier'],
-            'metric': GaugeMetricFamily(
-                'horizon_uag_edge_service_authenticated_sessions',
-                'VMware UAG Edge Service Authenticated Sessions',
-                labels=self._label_names + ['identifier'])
-        }, {
-            'path': ['viewEdgeServiceStats', 'edgeServiceSessionStats',
-                     'unauthenticatedSessions'],
-            'label': ['viewEdgeServiceStats', 'edgeServiceSessionStats',
-                      'identifier'],
-            'metric': GaugeMetricFamily(
-                'horizon_uag_edge_service_unauthenticated_sessions',
-                'VMware UAG Edge Service Unauthenticated Sessions',
-                labels=self._label_names + ['identifier'])
-        }, {
-            'path': ['viewEdgeServiceStats', 'edgeServiceSessionStats',
-                     'failedLoginAttempts'],
-            'label': ['viewEdgeServiceStats', 'edgeServiceSessionStats',
-                      'identifier'],
-            'metric': GaugeMetricFamily(
-                'horizon_uag_edge_service_failed_login_attempts',
-                'VMware UAG Edge Service Failed Login Attempts',
-                labels=self._label_names + ['identifier'])
-        }, {
-            'path': ['viewEdgeServiceStats', 'edgeServiceSessionStats',
-                     'userCount'],
-            'label': ['viewEdgeServiceStats', 'edgeServiceSessionStats',
-                      'identifier'],
-            'metric': GaugeMetricFamily(
-                'horizon_uag_edge_service_user_count',
-                'VMware UAG Edge Service User Count',
-                labels=self._label_names + ['identifier'])
-        }, {
-            'path': ['viewEdgeServiceStats', 'protocol'],
-            'rlabel': ['@name'],
-            'rdata': 'status',
-            'metric': InfoMetricFamily(
-                'horizon_uag_protocol_status',
-                'VMware UAG Protocol Status',
-                labels=self._label_names + ['name', 'reason', 'status'])
-        }, {
-            'path': ['viewEdgeServiceStats', 'protocol'],
-            'rlabel': ['@name'],
-            'rdata': 'sessions',
-            'metric': GaugeMetricFamily(
-                'horizon_uag_protocol_sessions',
-                'VMware UAG Protocol Sessions',
-                labels=self._label_names + ['name'])
-        }, {
-            'path': ['viewEdgeServiceStats', 'protocol'],
-            'rlabel': ['@name'],
-            'rdata': 'maxSessions',
-            'metric': GaugeMetricFamily(
-                'horizon_uag_protocol_max_sessions',
-                'VMware UAG Protocol Max Sessions',
-                labels=self._label_names + ['name'])
-        }, {
-            'path': ['viewEdgeServiceStats', 'protocol'],
-            'rlabel': ['@name'],
-            'rdata': 'unrecognizedRequestsCount',
-            'metric': GaugeMetricFamily(
-                'horizon_uag_protocol_unrecognized_requests_count',
-                'VMware UAG Protocol Unrecognized Requests Count',
-                labels=self._label_names + ['name'])
-        }, {
-            'path': ['applianceStats', 'freeMemoryMb'],
-            'metric': GaugeMetricFamily(
-                'horizon_uag_appliance_mem_free',
-                'VMware UAG Appliance Free Memory in Mb',
-                labels=self._label_names)
-        }, {
-            'path': ['applianceStats', 'totalMemoryMb'],
-            'metric': GaugeMetricFamily(
-                'horizon_uag_appliance_mem_total',
-                'VMware UAG Appliance Total Memory in Mb',
-                labels=self._label_names)
-        }, {
-            'path': ['applianceStats', 'totalCpuLoadPercent'],
-            'metric': GaugeMetricFamily(
-                'horizon_uag_appliance_cpu_load',
-                'VMware UAG Appliance Total CPU Load in Percent',
-                labels=self._label_names)
-        }]
-
-        self.metric_list_protocol = []
+    def __init__(self):
+        self._table = compile_metrics()
+        self.extract = compile_extractor()
 
-    def collect(self):
-        self._create_metric_list()
+    def collect_data(self, uag_data):
+        return self.collect_documents([((), uag_data)])
+
+    def collect_documents(self, documents, target_labels=()):
+        # Build the families of several stats documents at once, each
+        # labelled with its own values for `target_labels`.
+        documents = [(prefix, uag_data['accessPointStatusAndStats'])
+                     for prefix, uag_data in documents]
+
+        start = time.perf_counter()
+        families = []
+        for factory, name, documentation, labels, fill in self._table:
+            metric = factory(name, documentation,
+                             labels=list(target_labels) + labels)
+            filled = False
+            for prefix, uag_data in documents:
+                if fill(metric, uag_data, prefix):
+                    filled = True
+            if filled:
+                families.append(metric)
+
+        observe_build('uag', time.perf_counter() - start, families)
+        return families
+
+    def collect_appliances(self, snapshots, target_labels=(), ages=True):
+        # `snapshots` are (target, snapshot) pairs of UAGAppliance.
+        return (self.collect_appliance_data(snapshots, target_labels)
+                + self.collect_appliance_status(snapshots, target_labels,
+                                                ages))
+
+    def collect_appliance_data(self, snapshots, target_labels=()):
+        return self.collect_documents(
+            [((target,) if target_labels else (), snapshot['data'])
+             for target, snapshot in snapshots
+             if snapshot['data'] is not None],
+            target_labels)
+
+    def collect_appliance_status(self, snapshots, target_labels=(),
+                                 ages=True):
+        def prefix(target):
+            return (target,) if target_labels else ()
+
+        families = []
+        up = GaugeMetricFamily(
+            'horizon_uag_upstream_up',
+            'Whether the last fetch of the VMware UAG stats succeeded',
+            labels=list(target_labels))
+        circuit = GaugeMetricFamily(
+            'horizon_uag_circuit_open',
+            'Whether calls to the VMware UAG are suspended',
+            labels=list(target_labels))
+        families += [up, circuit]
+        if ages:
+            age = GaugeMetricFamily(
+                'horizon_uag_snapshot_age_seconds',
+                'Age of the served VMware UAG stats',
+                labels=list(target_labels))
+            families.append(age)
+        now = time.time()
+        for target, snapshot in snapshots:
+            up.add_metric(prefix(target), float(snapshot['up']))
+            circuit.add_metric(prefix(target),
+                               float(snapshot['circuit_open']))
+            if ages and snapshot['timestamp'] is not None:
+                age.add_metric(prefix(target), now - snapshot['timestamp'])
+        return families
+
+
+class UAGAppliance:
+    def __init__(self, target, breaker=None):
+        self.target = target
+        self.breaker = breaker if breaker is not None else CircuitBreaker()
+
+        # Replaced as a whole by each fetch, like the snapshot of a Horizon
+        # pod. A failed fetch keeps the data of the last successful one.
+        self.snapshot = None
+        self.future = None
+
+    @property
+    def generation(self):
+        snapshot = self.snapshot
+        return snapshot['generation'] if snapshot else 0
+
+    def update(self, uag_data):
+        # Replace the snapshot with a freshly fetched stats document, or
+        # mark the appliance as down when `uag_data` is None.
+        previous = self.snapshot
+        if uag_data is not None and \
+                'accessPointStatusAndStats' not in uag_data:
+            logger.error("Not a UAG stats document from %s", self.target)
+            uag_data = None
 
-        uag_data = UAG.get_data()
         if uag_data is None:
+            uag_data = previous['data'] if previous else None
+            timestamp = previous['timestamp'] if previous else None
+            up = False
+        else:
+            timestamp = time.time()
+            up = True
+
+        self.snapshot = {
+            'timestamp': timestamp,
+            'generation': self.generation + 1,
+            'data': uag_data,
+            'up': up,
+            'circuit_open': self.breaker.state != CircuitBreaker.CLOSED,
+        }
+
+    def fetch(self, get_monitor, timeout=None):
+        # Fetch the stats through the circuit breaker, which skips the call
+        # while the appliance is known to be down, and update the snapshot.
+        # Returns the digest of the stats document, or None on failure.
+        try:
+            uag_data, digest = self.breaker.call(
+                get_monitor, self.target, timeout=timeout)
+        except CircuitOpenError:
+            logger.debug("Circuit open for UAG %s", self.target)
+            uag_data, digest = None, None
+        except Exception:
+            logger.exception("Failed to fetch UAG stats from %s", self.target)
+            uag_data, digest = None, None
+        self.update(uag_data)
+        return digest
+
+
+class _ApplianceCollector:
+    # The snapshots of some appliances, from the fleet or from one probe,
+    # as they were when the collector was made.
+    def __init__(self, exporter, appliances, target_labels=(), ages=True):
+        self._exporter = exporter
+        self._snapshots = [(appliance.target, appliance.snapshot)
+                           for appliance in appliances
+                           if appliance.snapshot is not None]
+        self._target_labels = target_labels
+        self._ages = ages
+
+    @property
+    def generation(self):
+        # Fleet snapshots are told apart by their generation, and the
+        # snapshots of probed appliances, which may have been evicted and
+        # created again, also by the time they were fetched.
+        return tuple((target, snapshot['generation'], snapshot['timestamp'])
+                     for target, snapshot in self._snapshots)
+
+    def collect(self):
+        return iter(self._exporter.collect_appliances(
+            self._snapshots, self._target_labels, self._ages))
+
+    def collect_data(self):
+        return self._exporter.collect_appliance_data(
+            self._snapshots, self._target_labels)
+
+    def collect_status(self):
+        return self._exporter.collect_appliance_status(
+            self._snapshots, self._target_labels, self._ages)
+
+    @property
+    def data(self):
+        # The stats of the snapshots, which only change with the generation.
+        return FunctionCollector(self.collect_data)
+
+    @property
+    def status(self):
+        # Their status and age gauges, rendered on every scrape.
+        return FunctionCollector(self.collect_status)
+
+
+def get_target_groups():
+    # HORIZON_API_GATEWAY_GROUP_<NAME> lists the appliances probed together
+    # by ?group=<name>, separated by commas.
+    prefix = 'HORIZON_API_GATEWAY_GROUP_'
+    return {name[len(prefix):].lower(): get_env_list(name)
+            for name in os.environ if name.startswith(prefix)}
+
+
+class UAGFleet:
+    # Polls a fixed list of appliances in the background, so that probes
+    # and scrapes are served from the last snapshot of each appliance
+    # instead of waiting on it.
+    def __init__(self, uag, exporter, targets=None, interval=None,
+                 workers=None):
+        if targets is None:
+            targets = get_env_list('HORIZON_API_GATEWAY_TARGETS')
+        if interval is None:
+            interval = get_env_float('HORIZON_API_GATEWAY_POLL_INTERVAL', 30)
+        if workers is None:
+            workers = int(os.environ.get(
+                'HORIZON_API_GATEWAY_POLL_WORKERS',
+                max(1, min(len(targets), 16))))
+
+        self._uag = uag
+        self._exporter = exporter
+        self.interval = interval
+        self.timeout = get_env_float('HORIZON_API_GATEWAY_TIMEOUT', 10)
+        breaker = get_env_breaker('HORIZON_API_GATEWAY')
+        self.appliances = {target: UAGAppliance(target, breaker())
+                           for target in targets}
+
+        # At most `workers` appliances are fetched at a time. An appliance
+        # whose previous fetch is still running is skipped by the next
+        # round, so dead appliances cannot pile up in the pool and hold up
+        # the polling of healthy ones.
+        self._executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix='uag-fetch')
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+        # The fleet's snapshots are written to this file after every round
+        # of polls and read back at startup, so a restarted exporter serves
+        # the last stats of each appliance until it has been polled again.
+        self.snapshot_file = os.environ.get(
+            'HORIZON_API_GATEWAY_SNAPSHOT_FILE')
+        self._saved_generation = None
+
+    def get(self, target):
+        return self.appliances.get(target)
+
+    def _update(self, appliance):
+        appliance.fetch(self._uag.get_monitor, self.timeout)
+
+    def _submit(self, appliance):
+        with self._lock:
+            if appliance.future is None or appliance.future.done():
+                appliance.future = self._executor.submit(
+                    self._update, appliance)
+            return appliance.future
+
+    def refresh(self):
+        futures = [self._submit(appliance)
+                   for appliance in self.appliances.values()]
+        wait(futures)
+
+    def save_snapshot(self):
+        # Write the snapshots of the fleet, unless nothing changed since
+        # they were last written.
+        generation = self.generation
+        if generation == self._saved_generation:
+            return
+        appliances = {}
+        for target, appliance in self.appliances.items():
+            snapshot = appliance.snapshot
+            if snapshot is None or snapshot['data'] is None:
+                continue
+            appliances[target] = {
+                'timestamp': snapshot['timestamp'],
+                'data': snapshot['data'],
+                'up': snapshot['up'],
+            }
+        write_snapshot_file(self.snapshot_file, {
+            'version': SNAPSHOT_VERSION,
+            'appliances': appliances,
+        })
+        self._saved_generation = generation
+
+    def load_snapshot(self):
+        # Restore the snapshots written by save_snapshot() for the
+        # appliances that are still in the fleet.
+        state = read_snapshot_file(self.snapshot_file, SNAPSHOT_VERSION)
+        if state is None:
             return
+        loaded = 0
+        for target, saved in state['appliances'].items():
+            appliance = self.appliances.get(target)
+            if appliance is None:
+                continue
+            loaded += 1
+            appliance.snapshot = {
+                'timestamp': saved['timestamp'],
+                'generation': appliance.generation + 1,
+                'data': saved['data'],
+                'up': saved['up'],
+                'circuit_open': False,
+            }
+        logger.info("Loaded snapshots of %d UAG appliances", loaded)
+        self._saved_generation = self.generation
 
-        uag_data = uag_data['accessPointStatusAndStats']
+    def _save_snapshot(self):
+        try:
+            self.save_snapshot()
+        except Exception:
+            logger.exception("Failed to write snapshot file %s",
+                             self.snapshot_file)
 
-        for metric in self.metric_list:
+    def _poll(self):
+        while not self._stop.is_set():
+            if self.snapshot_file:
+                self._save_snapshot()
             try:
-                _data = get_nested_item(uag_data, metric['path'])
-            except KeyError:
-                continue
+                for appliance in self.appliances.values():
+                    self._submit(appliance)
+            except Exception:
+                logger.exception("Failed to schedule UAG polls")
+            self._stop.wait(self.interval)
+
+    def start(self):
+        if self.snapshot_file:
+            self.load_snapshot()
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._poll, name='uag-poller', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    @property
+    def generation(self):
+        return tuple(appliance.generation
+                     for appliance in self.appliances.values())
 
-            if type(_data) is not list:
-                _data = [_data]
-
-            if type(metric['metric']) is GaugeMetricFamily:
-                for _d in _data:
-                    if 'label' in metric:
-                        labels = [get_nested_item(uag_data, metric['label'])]
-                    else:
-                        labels = []
-
-                    if 'rlabel' in metric:
-                        for _l in metric['rlabel']:
-                            labels.append(_d[_l])
-                    if 'rdata' in metric:
-                        _d = _d[metric['rdata']]
-                    metric['metric'].add_metric(labels, float(_d))
-                yield metric['metric']
-
-            elif type(metric['metric']) is CounterMetricFamily:
-                for _d in _data:
-                    labels = []
-                    if 'rlabel' in metric:
-                        for _l in metric['rlabel']:
-                            labels.append(_d[_l])
-                    if 'rdata' in metric:
-                        _d = _d[metric['rdata']]
-                    metric['metric'].add_metric(labels, int(_d))
-                yield metric['metric']
-
-            elif type(metric['metric']) is InfoMetricFamily:
-                for _d in _data:
-                    labels = []
-                    if 'rlabel' in metric:
-                        for _l in metric['rlabel']:
-                            labels.append(_d[_l])
-                    if 'rdata' in metric:
-                        _d = _d[metric['rdata']]
-
-                    if type(_d) is not dict:
-                        _d = {metric['label']: _d}
-
-                    metric['metric'].add_metric(
-                        labels,
-                        {key: str(val) for key, val in _d.items()}
-                    )
-                yield metric['metric']
+    def get_collector(self, appliance):
+        return _ApplianceCollector(self._exporter, [appliance])
+
+    def _collector(self):
+        return _ApplianceCollector(
+            self._exporter, list(self.appliances.values()), ['target'])
+
+    def collect(self):
+        return self._collector().collect()
+
+    def collect_data(self):
+        return self._collector().collect_data()
+
+    def collect_status(self):
+        return self._collector().collect_status()
+
+    def get_cache(self, registry=None):
+        # A cache of the fleet's stats, served along with its status gauges
+        # and `registry`, which must not hold the fleet itself.
+        live = [FunctionCollector(self.collect_status)]
+        if registry is not None:
+            live.append(registry)
+        return ExpositionCache(FunctionCollector(self.collect_data), live)
 
 
 class MyRequestHandler(MetricsHandler):
+    uag = None
+    exporter = None
+    fleet = None
+    groups = None
+    probes = None
+    caches = None
+    fleet_cache = None
+    executor = None
+    timeout = None
+    scrape_offset = None
+
+    @classmethod
+    def factory(cls, uag, exporter, fleet=None, groups=None,
+                registry=REGISTRY):
+        # Every probe fetches into its own local state; the client, the
+        # compiled metric table and the per-target caches are shared.
+        if groups is None:
+            groups = get_target_groups()
+        breaker = get_env_breaker('HORIZON_API_GATEWAY')
+        return type(cls.__name__, (cls, object), {
+            'registry': registry,
+            'uag': uag,
+            'exporter': exporter,
+            'fleet': fleet,
+            'groups': groups,
+            # The last snapshot of each probed appliance, served as stale
+            # data when a probe fails.
+            'probes': ExpiringLRU(
+                lambda target: UAGAppliance(target, breaker()),
+                uag.max_targets, uag.idle_timeout),
+            'caches': ExpiringLRU(lambda host: ExpositionCache(),
+                                  uag.max_targets, uag.idle_timeout),
+            'fleet_cache': fleet.get_cache(registry) if fleet else None,
+            # Probes fetch their targets on this pool.
+            'executor': ThreadPoolExecutor(
+                max_workers=int(os.environ.get(
+                    'HORIZON_API_GATEWAY_CONCURRENCY', 64)),
+                thread_name_prefix='uag-batch'),
+            'timeout': get_env_float('HORIZON_API_GATEWAY_TIMEOUT', 10),
+            'scrape_offset': get_env_float(
+                'HORIZON_API_GATEWAY_SCRAPE_TIMEOUT_OFFSET', 0.5),
+        })
+
+    def _get_timeout(self):
+        return get_scrape_timeout(
+            self.headers.get('X-Prometheus-Scrape-Timeout-Seconds'),
+            self.timeout, self.scrape_offset)
+
+    def _result(self, appliance, future, deadline):
+        # Wait for a fetch submitted to the executor until `deadline`, and
+        # update the appliance with its stats, or mark it as down. Returns
+        # the digest of the stats document, or None on failure.
+        try:
+            uag_data, digest = future.result(
+                timeout=max(0, deadline - time.monotonic()))
+        except CircuitOpenError:
+            logger.debug("Circuit open for UAG %s", appliance.target)
+            uag_data, digest = None, None
+        except TimeoutError:
+            logger.warning("Timed out fetching UAG stats from %s",
+                           appliance.target)
+            uag_data, digest = None, None
+        except Exception:
+            logger.exception("Failed to fetch UAG stats from %s",
+                             appliance.target)
+            uag_data, digest = None, None
+        appliance.update(uag_data)
+        return digest
+
+    def _probe(self, host):
+        # The timeout of the HTTP client applies to each socket operation,
+        # so the fetch runs on the executor to keep the whole of it within
+        # the scrape timeout.
+        timeout = self._get_timeout()
+        appliance = self.probes.get(host)
+        future = self.executor.submit(
+            appliance.breaker.call, self.uag.get_monitor, host,
+            timeout=timeout)
+        digest = self._result(appliance, future, time.monotonic() + timeout)
+
+        if digest is not None:
+            # The stats document is hashed when it is fetched, so the body
+            # is only re-rendered when the appliance reports something new.
+            collector = _ApplianceCollector(self.exporter, [appliance],
+                                            ages=False)
+            generation = digest
+        else:
+            # A failed probe serves the last stats of the appliance, if
+            # any, with the time they were fetched.
+            collector = _ApplianceCollector(self.exporter, [appliance])
+            generation = collector.generation
+        send_cached(self, self.caches.get(host), generation, collector.data,
+                    [collector.status])
+
+    def _probe_batch(self, targets):
+        timeout = self._get_timeout()
+        appliances = []
+        futures = {}
+        for target in dict.fromkeys(targets):
+            appliance = self.fleet.get(target) if self.fleet else None
+            if appliance is None:
+                appliance = self.probes.get(target)
+                futures[target] = self.executor.submit(
+                    appliance.breaker.call, self.uag.get_monitor, target,
+                    timeout=timeout)
+            appliances.append(appliance)
+
+        # Appliances that have not answered by the deadline are served with
+        # their last stats and marked as down.
+        deadline = time.monotonic() + timeout
+        for appliance in appliances:
+            future = futures.get(appliance.target)
+            if future is not None:
+                self._result(appliance, future, deadline)
+
+        collector = _ApplianceCollector(self.exporter, appliances,
+                                        ['target'])
+        send_cached(self, self.caches.get(tuple(targets)),
+                    collector.generation, collector.data, [collector.status])
+
     def do_GET(self):
         parsed_path = urllib.parse.urlsplit(self.path)
         query = urllib.parse.parse_qs(parsed_path.query)
 
-        if "target" in query:
+        if "group" in query:
+            targets = self.groups.get(query['group'][0].lower())
+            if targets is None:
+                self.send_response(404)
+                self.end_headers()
+                self.wfile.write(b"Unknown group\n")
+                return
+            self._probe_batch(targets)
+        elif len(query.get("target", [])) > 1:
+            # Several targets are fetched concurrently and served as one
+            # exposition with a target label on every series.
+            self._probe_batch(query['target'])
+        elif "target" in query:
             host = query['target'][0]
-            UAG.get_monitor(host)
-            return super(MyRequestHandler, self).do_GET()
+            appliance = self.fleet.get(host) if self.fleet else None
+            if appliance is None:
+                self._probe(host)
+                return
+
+            # Appliances of the fleet are served from their last snapshot
+            # and never fetched by the probe itself.
+            collector = self.fleet.get_collector(appliance)
+            send_cached(self, self.caches.get(host), collector.generation,
+                        collector.data, [collector.status])
+        elif parsed_path.path == '/metrics':
+            if self.fleet:
+                send_cached(self, self.fleet_cache, self.fleet.generation)
+            else:
+                super().do_GET()
         else:
             self.send_response(404)
             self.end_headers()
@@ -254,10 +759,31 @@ class MyRequestHandler(MetricsHandler):
 
 
 def main():
-    REGISTRY.register(UAGExporter())
+    exporter = UAGExporter()
+    serve_async = os.environ.get('HORIZON_API_GATEWAY_ASYNC', '') not in (
+        '', '0')
+    uag = None if serve_async else horizon_uag(parse=exporter.extract)
+
+    # With HORIZON_API_GATEWAY_TARGETS set, the listed appliances are
+    # polled in the background and /metrics serves all of them.
+    fleet = None
+    if get_env_list('HORIZON_API_GATEWAY_TARGETS'):
+        fleet = UAGFleet(uag, exporter)
+
+    if serve_async:
+        # Serve and fetch from an event loop instead of a thread per probe.
+        from .uag_async import run
+        run(exporter, fleet)
+        return
+
+    if fleet:
+        fleet.start()
+    handler = MyRequestHandler.factory(uag, exporter, fleet)
 
     server_address = ('', 19000)
-    HTTPServer(server_address, MyRequestHandler).serve_forever()
+    httpd = ThreadingHTTPServer(server_address, handler)
+    httpd.daemon_threads = True
+    httpd.serve_forever()
 
 
 if __name__ == '__main__':
@@ -1,6 +1,382 @@
-from functools import reduce
-from operator import getitem
+import gzip
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from fnmatch import fnmatchcase
+from xml.parsers import expat
+from functools import lru_cache, partial
+from operator import itemgetter
+
+
+logger = logging.getLogger(__name__)
+
+# Shortest timeout in seconds given to an upstream call made for a scrape.
+# HTTP clients refuse a timeout of 0.
+MIN_SCRAPE_TIMEOUT = 0.1
+
+
+def compile_path(keys):
+    # Turn a path, given as a list of keys or a dotted string, into a
+    # callable doing the lookups directly, so that nothing needs to be
+    # flattened or re-walked for every record.
+    if isinstance(keys, str):
+        keys = keys.split('.')
+    keys = tuple(keys)
+
+    if len(keys) == 1:
+        return itemgetter(keys[0])
+    if len(keys) == 2:
+        first, second = keys
+        return lambda data: data[first][second]
+    if len(keys) == 3:
+        first, second, third = keys
+        return lambda data: data[first][second][third]
+
+    getters = tuple(itemgetter(key) for key in keys)
+
+    def get(data):
+        for getter in getters:
+            data = getter(data)
+        return data
+    return get
+
+
+@lru_cache(maxsize=256)
+def _compiled_path(keys):
+    return compile_path(keys)
 
 
 def get_nested_item(data, keys):
-    return reduce(getitem, keys, data)
+    return _compiled_path(tuple(keys))(data)
+
+
+def get_env_float(name, default):
+    value = os.environ.get(name)
+    if value is None or value == '':
+        return default
+    return float(value)
+
+
+def get_env_list(name):
+    value = os.environ.get(name, '')
+    return [item.strip() for item in value.split(',') if item.strip()]
+
+
+def get_scrape_timeout(value, default, offset=0.5):
+    # Prometheus sends its scrape timeout in the
+    # X-Prometheus-Scrape-Timeout-Seconds header. Upstream calls get what is
+    # left of it after `offset` seconds for rendering and sending the
+    # response, and never more than `default` or less than
+    # MIN_SCRAPE_TIMEOUT.
+    try:
+        timeout = float(value) - offset
+    except (TypeError, ValueError):
+        return default
+    return max(MIN_SCRAPE_TIMEOUT, min(default, timeout))
+
+
+def family_enabled(name, enabled, disabled):
+    if enabled and not any(fnmatchcase(name, p) for p in enabled):
+        return False
+    return not any(fnmatchcase(name, p) for p in disabled)
+
+
+def compile_xml_extractor(paths):
+    # Build a parser that only keeps the elements on one of `paths`, each a
+    # list of element names from the root down. The elements at the end of
+    # a path are kept whole, in the shape xmltodict.parse() gives them, and
+    # everything off the paths is skipped while parsing without being built.
+    tree = {}
+    for path in paths:
+        node = tree
+        for key in path[:-1]:
+            node = node.setdefault(key, {})
+            if node is None:
+                break
+        else:
+            node[path[-1]] = None
+
+    def extract(content):
+        # Each frame holds the selection below the element (None once the
+        # element is kept whole), its children and its text.
+        stack = [(tree, {}, [])]
+        skipped = 0
+
+        def start(name, attrs):
+            nonlocal skipped
+            if skipped:
+                skipped += 1
+                return
+            selection = stack[-1][0]
+            if selection is not None:
+                if name not in selection:
+                    skipped = 1
+                    return
+                selection = selection[name]
+            if selection is None:
+                children = {f'@{key}': value for key, value in attrs.items()}
+            else:
+                children = {}
+            stack.append((selection, children, []))
+
+        def end(name):
+            nonlocal skipped
+            if skipped:
+                skipped -= 1
+                return
+            selection, children, text = stack.pop()
+            text = ''.join(text).strip()
+            if selection is not None:
+                value = children
+            elif children:
+                value = children
+                if text:
+                    value['#text'] = text
+            else:
+                value = text or None
+
+            parent = stack[-1][1]
+            if name not in parent:
+                parent[name] = value
+            elif type(parent[name]) is list:
+                parent[name].append(value)
+            else:
+                parent[name] = [parent[name], value]
+
+        def characters(data):
+            if not skipped and stack[-1][0] is None:
+                stack[-1][2].append(data)
+
+        parser = expat.ParserCreate()
+        parser.buffer_text = True
+        parser.StartElementHandler = start
+        parser.EndElementHandler = end
+        parser.CharacterDataHandler = characters
+        parser.Parse(content, True)
+        return stack[0][1]
+
+    return extract
+
+
+class ExpiringLRU:
+    # Values built on demand per key, keeping at most `maxsize` of them and
+    # dropping those that have not been used for `idle` seconds. Evicted
+    # values are handed to `close`, outside of the lock.
+    def __init__(self, create, maxsize=128, idle=300, close=None):
+        self._create = create
+        self._maxsize = maxsize
+        self._idle = idle
+        self._close = close
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        now = time.monotonic()
+        evicted = []
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            # Entries are kept in order of use, so the ones to evict are
+            # always at the front.
+            while self._entries:
+                oldest, (value, used) = next(iter(self._entries.items()))
+                if (len(self._entries) < self._maxsize
+                        and now - used < self._idle):
+                    break
+                del self._entries[oldest]
+                evicted.append(value)
+
+            value = self._create(key) if entry is None else entry[0]
+            self._entries[key] = (value, now)
+
+        if self._close is not None:
+            for old in evicted:
+                self._close(old)
+        return value
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class CircuitBreaker:
+    # Stops calling an upstream that keeps failing. After `threshold`
+    # failures in a row the circuit opens for `backoff` seconds. Once they
+    # have passed, a single trial call is let through (half-open). Its
+    # success closes the circuit again, and its failure opens it for twice
+    # as long, up to `max_backoff`.
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, threshold=3, backoff=60, max_backoff=900):
+        self._threshold = threshold
+        self._backoff = backoff
+        self._max_backoff = max_backoff
+        self._delay = backoff
+        self._failures = 0
+        self._retry_at = 0
+        self._lock = threading.Lock()
+        self.state = self.CLOSED
+
+    def allow(self):
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and \
+                    time.monotonic() >= self._retry_at:
+                self.state = self.HALF_OPEN
+                return True
+            return False
+
+    def success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self._failures = 0
+            self._delay = self._backoff
+
+    def failure(self):
+        with self._lock:
+            self._failures += 1
+            if self.state == self.HALF_OPEN:
+                self._delay = min(self._delay * 2, self._max_backoff)
+            elif self.state == self.OPEN or \
+                    self._failures < self._threshold:
+                return
+            self.state = self.OPEN
+            self._retry_at = time.monotonic() + self._delay
+
+    def abandon(self):
+        # A call that neither succeeded nor failed, e.g. one cancelled when
+        # its scraper went away. A trial call gives its slot back, so the
+        # next call is a trial again instead of the circuit staying
+        # half-open for good.
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                self.state = self.OPEN
+
+    def call(self, func, *args, **kwargs):
+        if not self.allow():
+            raise CircuitOpenError("Circuit open")
+        try:
+            result = func(*args, **kwargs)
+        except Exception:
+            self.failure()
+            raise
+        except BaseException:
+            self.abandon()
+            raise
+        self.success()
+        return result
+
+    async def call_async(self, func, *args, **kwargs):
+        if not self.allow():
+            raise CircuitOpenError("Circuit open")
+        try:
+            result = await func(*args, **kwargs)
+        except Exception:
+            self.failure()
+            raise
+        except BaseException:
+            self.abandon()
+            raise
+        self.success()
+        return result
+
+
+def get_env_breaker(prefix):
+    # Circuit breakers configured by <prefix>_BREAKER_FAILURES,
+    # <prefix>_BREAKER_BACKOFF and <prefix>_BREAKER_MAX_BACKOFF.
+    return partial(
+        CircuitBreaker,
+        int(os.environ.get(f'{prefix}_BREAKER_FAILURES', 3)),
+        get_env_float(f'{prefix}_BREAKER_BACKOFF', 60),
+        get_env_float(f'{prefix}_BREAKER_MAX_BACKOFF', 900))
+
+
+def write_snapshot_file(path, state):
+    # Write `state` as gzipped JSON to a temporary file next to `path` and
+    # move it into place, so that a crash halfway through never leaves a
+    # truncated snapshot behind.
+    fd, temporary = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(path)), prefix='.snapshot-')
+    try:
+        with os.fdopen(fd, 'wb') as file:
+            file.write(gzip.compress(
+                json.dumps(state, separators=(',', ':')).encode()))
+        os.replace(temporary, path)
+    except BaseException:
+        os.unlink(temporary)
+        raise
+
+
+def read_snapshot_file(path, version):
+    # Return the state written by write_snapshot_file(), or None when there
+    # is no such file or it cannot be used, in which case the exporter
+    # simply starts cold.
+    try:
+        with gzip.open(path, 'rb') as file:
+            state = json.load(file)
+    except FileNotFoundError:
+        return None
+    except Exception:
+        logger.exception("Failed to read snapshot file %s", path)
+        return None
+    if not isinstance(state, dict) or state.get('version') != version:
+        logger.warning("Ignoring snapshot file %s of another version", path)
+        return None
+    return state
+
+
+def iter_json_array(chunks):
+    # Decode the items of a top level JSON array from an iterable of text
+    # chunks, without ever holding the whole document in memory.
+    decoder = json.JSONDecoder()
+    whitespace = ' \t\n\r,'
+    buffer = ''
+    started = False
+
+    for chunk in chunks:
+        buffer += chunk
+        pos = 0
+        length = len(buffer)
+
+        if not started:
+            while pos < length and buffer[pos] in whitespace:
+                pos += 1
+            if pos == length:
+                buffer = ''
+                continue
+            if buffer[pos] != '[':
+                raise ValueError("Expected a JSON array")
+            started = True
+            pos += 1
+
+        while True:
+            while pos < length and buffer[pos] in whitespace:
+                pos += 1
+            if pos < length and buffer[pos] == ']':
+                return
+            try:
+                item, end = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                break
+            # A value that is not followed by a separator may still be
+            # incomplete (e.g. a number cut at "2."), so wait for the next
+            # chunk before handing it out.
+            if end == length or buffer[end] not in whitespace + ']':
+                break
+            yield item
+            pos = end
+
+        buffer = buffer[pos:]
+
+    if not started:
+        raise ValueError("Expected a JSON array")
+    raise ValueError("Unterminated JSON array")
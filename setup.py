@@ -10,7 +10,7 @@ import versioneer
 # and/or pip.
 min_version = (
     3,
-    1,
+    9,
 )
 if sys.version_info < min_version:
     error = """
@@ -48,7 +48,8 @@ setup(
     author_email="",
     url="https://github.com/NSLS-II/horizon_exporter",
     python_requires=">={}".format(".".join(str(n) for n in min_version)),
-    packages=find_packages(exclude=["docs", "tests"]),
+    packages=find_packages(exclude=["docs", "tests", "*.tests", "benchmarks",
+                                    "benchmarks.*"]),
     entry_points={
         'console_scripts': [
             'horizon_exporter=horizon_exporter.horizon_exporter:main',